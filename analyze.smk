@@ -4,8 +4,14 @@ configfile: "config.yaml"
 
 #trees too big to finish 1000 bootstrap replicates inside the 12h medium partition.
 #these get the long partition instead. add virus names here if others time out.
+#check_multi_split_spectra checkpoints into checkpoints/{virus}, so a tree that times out on
+#medium can also just be resubmitted and it carries on from where the last job stopped.
 LONG_RUNNING = {"Human_immunodeficiency_virus_1"}
 
+def multi_split_runtime(wildcards):
+    #minutes
+    return 10080 if wildcards.virus in LONG_RUNNING else 720
+
 rule all:
     input:
         expand("visuals/{virus}_split_visualization.jsonl.gz", virus=config["viruses"]),
@@ -117,6 +123,8 @@ rule mask_muts:
         pruned_tree="pruned/{virus}_pruned.pb.gz"
     output:
         masked_tree="pruned/{virus}_pruned_masked.pb.gz"
+    #the masks also go to pruned/{virus}_pruned_masked.mask_plan.tsv (not an output, a failed job leaves it be).
+    #after editing or filtering it, mask_site_splits.py --apply_plan re-masks the pruned tree without the chi scan
     threads:
         config["threads"]
     log:
@@ -128,7 +136,7 @@ rule mask_muts:
         #slurm_extra="--export=ALL",
     shell:
         """
-        python3 spectrumSplits/qc/mask_site_splits.py --input_tree {input.pruned_tree} --output_tree {output.masked_tree} --calculate_max_chi --calculate_min_mutations --nthreads {threads} > {log} 2>&1
+        python3 spectrumSplits/qc/mask_site_splits.py --input_tree {input.pruned_tree} --output_tree {output.masked_tree} --calculate_max_chi --calculate_min_mutations --engine scan --nthreads {threads} > {log} 2>&1
         """
 
 rule convert_masked:
@@ -148,9 +156,30 @@ rule convert_masked:
         usher_to_taxonium -i {input.masked_tree} -t {wildcards.virus} -o {output.final_tree} > {log} 2>&1
         """
 
-rule check_single_split_spectra:
+#arrays of the masked tree, read by the spectrum scripts in place of the protobuf so it is only
+#decompressed and parsed once per virus. they check the sha256 in it and ignore a stale cache.
+rule cache_tree:
     input:
         masked_tree="pruned/{virus}_pruned_masked.pb.gz"
+    output:
+        tree_cache=directory("pruned/{virus}_pruned_masked.pb.gz.cache")
+    log:
+        "logs/{virus}_cache_tree.log"
+    resources:
+        mem_mb=4000,
+        runtime=720,
+        slurm_partition="medium",
+        #slurm_extra="--export=ALL",
+    shell:
+        """
+        python3 spectrumSplits/tree_cache.py --input_tree {input.masked_tree} > {log} 2>&1
+        """
+
+#its own cheap job rather than a --sweep setting of check_multi_split_spectra, so single_split_pca doesn't
+#wait on the bootstraps and a bootstrap failure or time budget stop doesn't take this report with it
+rule check_single_split_spectra:
+    input:
+        masked_tree="pruned/{virus}_pruned_masked.pb.gz", tree_cache="pruned/{virus}_pruned_masked.pb.gz.cache"
     output:
         split_report="reports/{virus}_single_split_report.txt"
     threads:
@@ -164,8 +193,6 @@ rule check_single_split_spectra:
         #slurm_extra="--export=ALL",
     shell:
         """
-        mkdir -p bootstraps
-        mkdir -p bootstraps/{wildcards.virus}
         mkdir -p reports
         python3 spectrumSplits/spectrumSplits.py --input_tree {input.masked_tree} --output_spectrum {output.split_report} --min_chi 100000 > {log} 2>&1
         """
@@ -194,14 +221,25 @@ rule single_split_pca:
         
 rule check_multi_split_spectra:
     input:
-        masked_tree="pruned/{virus}_pruned_masked.pb.gz"
+        masked_tree="pruned/{virus}_pruned_masked.pb.gz", tree_cache="pruned/{virus}_pruned_masked.pb.gz.cache"
     output:
         split_report="reports/{virus}_multi_split_report.txt",
-        #declared so snakemake knows this rule creates it and runs check_bootstraps after.
+        #split support tallied as each replicate finishes, rewritten every few replicates so it can be watched
+        #mid run. a rerun picks the tally up from the checkpoint. split_support.py redoes it from bootstraps/{virus}
+        bootstrap_report="reports/{virus}_bootstrap_report.tsv",
         #note snakemake clears this directory before a rerun and on failure.
         bootstrap_dir=directory("bootstraps/{virus}")
     params:
-        bootstrap_splits=config["bootstrap_replicates"]
+        bootstrap_splits=config["bootstrap_replicates"],
+        #not an output, so snakemake leaves it alone when the job fails or times out.
+        #a rerun resumes the split search and skips replicates already listed in its manifest
+        checkpoint_dir="checkpoints/{virus}",
+        #timings, chi tests per second, per replicate times and peak RSS, for sizing the resources below.
+        #a param rather than an output so a job killed at its time limit keeps it
+        metrics_file="logs/{virus}_check_multi_split_spectra_metrics.json",
+        #seconds. a split search that won't finish stops 15 minutes before the job's time limit and writes
+        #reports/{virus}_multi_split_report.not_converged.tsv, a rerun carries on from the checkpoint
+        time_budget=lambda wildcards: (multi_split_runtime(wildcards) - 15) * 60
     threads:
         config["threads"]
     log:
@@ -210,7 +248,7 @@ rule check_multi_split_spectra:
         mem_mb=4000,
         #HIV-1 is by far the largest tree here (~1.5M mutations, ~34k tips) and needs
         #roughly 54h for 1000 bootstrap replicates, well past the 12h medium cap.
-        runtime=lambda wildcards: 10080 if wildcards.virus in LONG_RUNNING else 720,
+        runtime=multi_split_runtime,
         slurm_partition=lambda wildcards: "long" if wildcards.virus in LONG_RUNNING else "medium",
         #slurm_extra="--export=ALL",
     shell:
@@ -218,32 +256,9 @@ rule check_multi_split_spectra:
         mkdir -p bootstraps
         mkdir -p bootstraps/{wildcards.virus}
         mkdir -p reports
-        python3 spectrumSplits/spectrumSplits.py --input_tree {input.masked_tree} --output_spectrum {output.split_report} --bootstrap_splits {params.bootstrap_splits} --bootstrap_dir bootstraps/{wildcards.virus} --nthreads {threads} --calculate_min_chi > {log} 2>&1
+        python3 spectrumSplits/spectrumSplits.py --input_tree {input.masked_tree} --output_spectrum {output.split_report} --bootstrap_splits {params.bootstrap_splits} --bootstrap_dir bootstraps/{wildcards.virus} --bootstrap_report {output.bootstrap_report} --checkpoint_dir {params.checkpoint_dir} --metrics_file {params.metrics_file} --time_budget {params.time_budget} --nthreads {threads} --calculate_min_chi > {log} 2>&1
         """
 
-rule check_bootstraps:
-    input:
-        bootstrap_directory="bootstraps/{virus}", input_tree="pruned/{virus}_pruned_masked.pb.gz"
-    output:
-        bootstrap_report="reports/{virus}_bootstrap_report.tsv"
-    params:
-        bootstrap_splits=config["bootstrap_replicates"]
-    threads:
-        config["threads"]
-    log:
-        "logs/{virus}_check_bootstraps.log"
-    resources:
-        mem_mb=4000,
-        runtime=720,
-        slurm_partition="medium",
-        #slurm_extra="--export=ALL",
-    shell:
-        """
-        mkdir -p reports
-        python3 spectrumSplits/misc/process_bootstraps.py --bootstrap_directory {input.bootstrap_directory} --spectrum_file reports/{wildcards.virus}_multi_split_report.txt --output_file {output.bootstrap_report} --input_tree {input.input_tree} > {log} 2>&1
-       """
-
-
 rule visualize_splits:
     input:
         masked_tree="pruned/{virus}_pruned_masked.pb.gz", spectrum_file="reports/{virus}_multi_split_report.txt"
@@ -0,0 +1,63 @@
+import io
+import os
+import sys
+import json
+import argparse
+import contextlib
+import importlib.util
+#the synthetic trees and the reference key come from the benchmark
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from synthetic_trees import random_tree
+from bench_stages import REFERENCE, reference_key
+
+### splits stored in reference_splits.json, found by the pre-series find_splits (spectrumSplits.py as it was
+### before the index engine and the rest of the engines bench_stages.py checks were added), so a regression
+### in those engines can't end up in the reference they're checked against. the pre-series script is the
+### parent of the commit that added tree_index.py, given as a file:
+###     git show "$(git log --format=%H --diff-filter=A -- spectrumSplits/tree_index.py)^:spectrumSplits/spectrumSplits.py" > /tmp/baseline_spectrumSplits.py
+###     python baseline_reference.py --baseline /tmp/baseline_spectrumSplits.py
+
+BASELINE = "output of the pre-series find_splits (spectrumSplits.py before tree_index.py was added), stored by baseline_reference.py"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Store the splits the baseline find_splits finds on the benchmark's synthetic trees as the reference bench_stages.py checks every engine against.")
+    parser.add_argument("--baseline", type=str, required=True, help="spectrumSplits.py from before tree_index.py was added (the parent of the commit adding it)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000], help="Tip counts to store references for")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic trees")
+    parser.add_argument("--ladderness", type=float, default=0.0, help="0 for a random (Yule) tree, 1 for a caterpillar")
+    parser.add_argument("--mutations_per_branch", type=int, default=5, help="Mean mutations per branch")
+    parser.add_argument("--nsites", type=int, default=3000, help="Number of variable sites")
+    parser.add_argument("--shifts", type=int, default=8, help="Number of clades with a planted spectrum shift")
+    parser.add_argument("--min_mutations", type=int, default=200, help="find_splits --min_mutations (the chi threshold is calculated from the tree size)")
+    return parser.parse_args()
+
+def load_baseline(path):
+    spec = importlib.util.spec_from_file_location("baseline_spectrumSplits", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def main():
+    args = parse_args()
+    baseline = load_baseline(args.baseline)
+    #the baseline walks the tree recursively
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+    references = {}
+    if os.path.exists(REFERENCE):
+        with open(REFERENCE) as f:
+            references = json.load(f)
+    for ntips in args.sizes:
+        tree = random_tree(ntips, args.seed, args.ladderness, args.mutations_per_branch, args.nsites, args.shifts)
+        size = len(tree.breadth_first_expansion())
+        #the baseline prints every chi value it computes, and its progress to stderr
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            splits = baseline.find_splits(tree.root, 0, args.min_mutations, 100000, calculate_min_chi=True, tree_size=size)
+        key = reference_key(args, ntips)
+        references[key] = sorted(split.id for split in splits)
+        print(f"#{key}: {len(splits)} splits", file=sys.stderr)
+    references["_source"] = BASELINE
+    with open(REFERENCE, "w") as f:
+        json.dump(references, f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
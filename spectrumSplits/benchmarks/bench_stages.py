@@ -0,0 +1,247 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import filecmp
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+#the scripts being measured live one (and two) directories up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "qc"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "viralUSherSpectra"))
+from synthetic_trees import random_tree
+from traversal import TreeOrder
+from tree_index import TreeIndex
+from mutation_table import decode_mutations
+from bootstrap_engine import draw_weights, replicate_rng, split_spectra_matrix
+from spectrumSplits import (find_splits, find_splits_indexed, find_splits_incremental, get_spectra, get_spectra_indexed,
+                            bootstrap_replicate, bootstrap_spectrum_replicate, write_spectra_to_tsv, node_depth)
+from split_hierarchy import SplitHierarchy, load_hierarchy, replay_splits, write_replay_report
+from mask_site_splits import get_mutation_counts, find_site_splits, scan_site_splits, mask_mutations
+from prune_mutation_sample_ratio import compute_descendants_mutations_ratio, detect_changepoints, compute_threshold
+
+### time and peak memory of every stage that walks the tree, on synthetic trees from a few thousand
+### tips up to HIV-1 scale (~34k tips, ~1.5M mutations: --sizes 34000 --mutations_per_branch 22),
+### and a check that every split search engine still finds the splits stored in reference_splits.json,
+### which baseline_reference.py stores from the pre-series find_splits, not from any engine checked here.
+### the split_hierarchy_replay stage also checks that a replayed split hierarchy writes the same report
+### as a direct search, at the recorded settings and at a stricter min_chi
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference_splits.json")
+STAGES = ["find_splits", "find_splits_indexed", "find_splits_incremental", "find_splits_bounded", "find_splits_indexed_bounded", "get_spectra", "get_spectra_indexed",
+          "bootstrap_replicate", "bootstrap_replicate_indexed", "bootstrap_spectrum_replicate", "bootstrap_spectra_batch",
+          "find_site_splits", "scan_site_splits", "mask_mutations", "prune_mutation_sample_ratio", "select_non_overlapping",
+          "split_hierarchy_replay"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the tree walking stages on synthetic trees and check split results against a stored reference.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000], help="Tip counts to run")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic trees and bootstrap draws")
+    parser.add_argument("--ladderness", type=float, default=0.0, help="0 for a random (Yule) tree, 1 for a caterpillar")
+    parser.add_argument("--mutations_per_branch", type=int, default=5, help="Mean mutations per branch")
+    parser.add_argument("--nsites", type=int, default=3000, help="Number of variable sites")
+    parser.add_argument("--shifts", type=int, default=8, help="Number of clades with a planted spectrum shift")
+    parser.add_argument("--min_mutations", type=int, default=200, help="find_splits --min_mutations (the chi threshold is calculated from the tree size, as in the pipeline)")
+    parser.add_argument("--sites", type=int, default=50, help="Most mutated sites run through find_site_splits and scan_site_splits")
+    parser.add_argument("--batch_size", type=int, default=20, help="Replicates in the bootstrap_spectra_batch stage")
+    parser.add_argument("--stages", type=str, nargs="+", default=STAGES, choices=STAGES, help="Stages to run (the recursive ones take hours at HIV-1 scale)")
+    parser.add_argument("--no_memory", action="store_true", help="Skip the second, tracemalloc, pass over each stage (memory is measured separately because tracemalloc slows python code down)")
+    return parser.parse_args()
+
+class SiteArgs:
+    #the settings find_site_splits reads from the mask_site_splits command line, everything above mask_chi is masked
+    min_total = 50
+    mask_chi = 0
+
+def reference_key(args, ntips):
+    return f"tips={ntips} seed={args.seed} ladderness={args.ladderness} mutations_per_branch={args.mutations_per_branch} nsites={args.nsites} shifts={args.shifts} min_mutations={args.min_mutations}"
+
+def measure(prepare, memory=True):
+    #prepare() does any setup outside the timing and returns the call to measure
+    function = prepare()
+    start = time.perf_counter()
+    function()
+    elapsed = f"{time.perf_counter() - start:.3f}s"
+    if not memory:
+        return f"{elapsed}\tNA"
+    function = prepare()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return f"{elapsed}\t{peak:.1f}MB"
+
+def top_sites(tree, table, nsites):
+    #position -> count of the nsites most mutated sites
+    counts = get_mutation_counts(tree.root, table)
+    return {position: counts[position] for position in sorted(counts, key=lambda position: (-counts[position], position))[:nsites]}
+
+def site_masks(tree, order, table, nsites):
+    #find_site_splits over the nsites most mutated sites, as mask_site_splits runs it (without the processes)
+    below, above, chi_list = {}, {}, []
+    for position, count in top_sites(tree, table, nsites).items():
+        find_site_splits(position, count, len(table), tree.root, SiteArgs, below, above, chi_list, order, table)
+    return below, above
+
+def scan_stage(tree, order, table, nsites):
+    #the same sites as find_site_splits, all in one scan
+    sites = top_sites(tree, table, nsites)
+    return lambda: scan_site_splits(sites, len(table), order, table, SiteArgs.min_total)
+
+def prune_stage(tree):
+    mutation_ratio = {}
+    compute_descendants_mutations_ratio(tree.root, mutation_ratio)
+    with contextlib.redirect_stdout(io.StringIO()):
+        threshold = compute_threshold(mutation_ratio)
+    detect_changepoints(tree.root, mutation_ratio, threshold, [], set())
+
+def overlapping_trees(tree, order, ntrees=200):
+    #leaf sets as dedup sees them: the tips of ntrees clades (so they nest and overlap) plus a shared reference sample
+    internal = [node for node in order.nodes if node.children]
+    step = max(1, len(internal) // ntrees)
+    return [(node.id, None, set(tip.id for tip in order.subtree(node) if not tip.children) | {"reference"}) for node in internal[::step]]
+
+def split_ids(splits):
+    return sorted(split.id for split in splits)
+
+def record_hierarchy(index, size, args, directory):
+    #the split hierarchy of the pipeline's search (calculated min_chi), as written and read back by the scripts
+    hierarchy = SplitHierarchy()
+    find_splits_indexed(index, 0, args.min_mutations, calculate_min_chi=True, tree_size=size, hierarchy=hierarchy)
+    path = os.path.join(directory, "split_hierarchy.json")
+    hierarchy.write(path, index, {"input_tree": "synthetic", "tree_size": size, "min_chi": 0, "calculate_min_chi": True,
+                                  "min_mutations": args.min_mutations, "max_branch_length": 100000}, node_depth)
+    return load_hierarchy(path)
+
+def stricter_min_chi(record):
+    #a fixed min_chi over every recorded threshold, past the median accepted chi so about half the splits go
+    chis = sorted(event["chi"] for event in record["events"] if "split" in event)
+    return max([event["min_chi"] for event in record["events"]] + chis[len(chis) // 2:len(chis) // 2 + 1])
+
+def replay_stage(index, size, args, directory):
+    record = record_hierarchy(index, size, args, directory)
+    return lambda: write_replay_report(record, replay_splits(record, 0, True), os.path.join(directory, "replayed.tsv"))
+
+def check_replay(index, size, args, directory, key):
+    '''
+    Number of settings (the recorded ones, then a stricter min_chi) at which the report replayed from
+    the split hierarchy differs from the report of a direct search.
+    '''
+    record = record_hierarchy(index, size, args, directory)
+    replayed, direct = os.path.join(directory, "replayed.tsv"), os.path.join(directory, "direct.tsv")
+    wrong = 0
+    for min_chi, calculate_min_chi in [(0, True), (stricter_min_chi(record), False)]:
+        setting = "calculated min_chi" if calculate_min_chi else f"min_chi {min_chi:.1f}"
+        kept = replay_splits(record, min_chi, calculate_min_chi)
+        write_replay_report(record, kept, replayed)
+        finalized = find_splits_indexed(index, min_chi, args.min_mutations, calculate_min_chi=calculate_min_chi, tree_size=size)
+        write_spectra_to_tsv(get_spectra_indexed(index, finalized), direct, 0)
+        if filecmp.cmp(replayed, direct, shallow=False):
+            print(f"#{key}: {len(kept)} replayed splits at {setting} match the direct search", file=sys.stderr)
+        else:
+            print(f"#{key}: replayed report at {setting} ({len(kept)} splits) differs from the direct search ({len(finalized)} splits)", file=sys.stderr)
+            wrong += 1
+    return wrong
+
+def main():
+    args = parse_args()
+    memory = not args.no_memory
+    references = {}
+    if os.path.exists(REFERENCE):
+        with open(REFERENCE) as f:
+            references = json.load(f)
+    mismatches = 0
+    #hierarchy records and reports of the split_hierarchy_replay stage
+    workdir = tempfile.TemporaryDirectory()
+    print("tips\tnodes\tmutations\tstage\ttime\tpeak_memory")
+    for ntips in args.sizes:
+        make_tree = lambda: random_tree(ntips, args.seed, args.ladderness, args.mutations_per_branch, args.nsites, args.shifts)
+        tree = make_tree()
+        order = TreeOrder(tree.root)
+        table = decode_mutations(order.nodes)
+        index = TreeIndex(tree.root)
+        size = len(order)
+        splits = {}
+
+        def run_search(stage):
+            #the result of the timed run is kept for the reference check
+            bounded = stage.endswith("_bounded")
+            def call():
+                if stage.startswith("find_splits_indexed"):
+                    splits[stage] = split_ids(find_splits_indexed(index, 0, args.min_mutations, calculate_min_chi=True, tree_size=size, bounded=bounded))
+                elif stage == "find_splits_incremental":
+                    splits[stage] = split_ids(find_splits_incremental(index, 0, args.min_mutations, calculate_min_chi=True, tree_size=size))
+                else:
+                    splits[stage] = split_ids(find_splits(tree.root, 0, args.min_mutations, 100000, calculate_min_chi=True, tree_size=size, bounded=bounded))
+            return call
+
+        #splits the later stages start from
+        finalized = find_splits_indexed(index, 0, args.min_mutations, calculate_min_chi=True, tree_size=size)
+        weights = [draw_weights(len(index.positions), 1, replicate_rng(args.seed, replicate))[:, 0] for replicate in range(1, args.batch_size + 1)]
+        benchmarks = {
+            "find_splits": lambda: run_search("find_splits"),
+            "find_splits_indexed": lambda: run_search("find_splits_indexed"),
+            "find_splits_incremental": lambda: run_search("find_splits_incremental"),
+            "find_splits_bounded": lambda: run_search("find_splits_bounded"),
+            "find_splits_indexed_bounded": lambda: run_search("find_splits_indexed_bounded"),
+            "get_spectra": lambda: lambda: get_spectra(finalized, 100000),
+            "get_spectra_indexed": lambda: lambda: get_spectra_indexed(index, finalized),
+            "bootstrap_replicate": lambda: lambda: bootstrap_replicate(tree, 1, 0, args.min_mutations, 0, 100000, True, seed=args.seed, output="npz"),
+            "bootstrap_replicate_indexed": lambda: lambda: bootstrap_replicate(tree, 1, 0, args.min_mutations, 0, 100000, True, index=index, seed=args.seed, output="npz"),
+            "bootstrap_spectrum_replicate": lambda: lambda: bootstrap_spectrum_replicate(tree, 1, finalized, 100000, seed=args.seed, output="npz"),
+            "bootstrap_spectra_batch": lambda: lambda: split_spectra_matrix(index, list(finalized), np.column_stack(weights)),
+            "find_site_splits": lambda: lambda: site_masks(tree, order, table, args.sites),
+            "scan_site_splits": lambda: scan_stage(tree, order, table, args.sites),
+            "prune_mutation_sample_ratio": lambda: lambda: prune_stage(tree),
+            "select_non_overlapping": lambda: select_stage(tree, order),
+            "split_hierarchy_replay": lambda: replay_stage(index, size, args, workdir.name),
+        }
+
+        def mask_stage():
+            #masking edits the tree, so each run gets a fresh copy with the masks worked out beforehand
+            fresh = make_tree()
+            fresh_order = TreeOrder(fresh.root)
+            below, above = site_masks(fresh, fresh_order, decode_mutations(fresh_order.nodes), args.sites)
+            return lambda: mask_mutations(fresh.root, below, above, fresh_order)
+        benchmarks["mask_mutations"] = mask_stage
+
+        for stage in args.stages:
+            try:
+                result = measure(benchmarks[stage], memory)
+            except ImportError as error:
+                result = f"{type(error).__name__}: {error}\tNA"
+            print(f"{ntips}\t{size}\t{len(table)}\t{stage}\t{result}", flush=True)
+
+        #every engine that ran has to find the reference splits
+        if splits:
+            mismatches += check_reference(references, reference_key(args, ntips), splits)
+        if "split_hierarchy_replay" in args.stages:
+            mismatches += check_replay(index, size, args, workdir.name, reference_key(args, ntips))
+
+    workdir.cleanup()
+    sys.exit(1 if mismatches else 0)
+
+def check_reference(references, key, splits):
+    #number of engines whose splits differ from the reference
+    if key not in references:
+        print(f"#{key}: no reference splits stored, run baseline_reference.py for these settings", file=sys.stderr)
+        return 0
+    wrong = [stage for stage, found in splits.items() if found != references[key]]
+    for stage in wrong:
+        print(f"#{key}: {stage} found {len(splits[stage])} splits, not the {len(references[key])} reference splits", file=sys.stderr)
+    if not wrong:
+        print(f"#{key}: {len(references[key])} splits match the reference", file=sys.stderr)
+    return len(wrong)
+
+def select_stage(tree, order):
+    #dedup imports bte and rich itself
+    from dedup import select_non_overlapping
+    trees = overlapping_trees(tree, order)
+    return lambda: select_non_overlapping(trees, {"reference"})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from collections import defaultdict
+#the scripts being measured live one (and two) directories up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "qc"))
+from synthetic_trees import ladder_tree
+from traversal import TreeOrder
+from mutation_table import decode_mutations
+from spectrumSplits import compute_mutation_spectrum, get_tips, get_positions
+from mask_site_splits import get_mutation_counts, find_site_splits, find_node
+from prune_mutation_sample_ratio import compute_descendants_mutations_ratio
+
+### time and peak memory of the tree walks on ladder trees thousands of levels deep, next to the
+### recursive compute_mutation_spectrum they replaced (which stops at python's recursion limit)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark tree traversals on deep synthetic trees.")
+    parser.add_argument("--depths", type=int, nargs="+", default=[1000, 10000], help="Ladder tree depths to run (find_site_splits takes minutes past ~50000)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic mutations")
+    return parser.parse_args()
+
+def recursive_spectrum(node, spectrum_dict):
+    #compute_mutation_spectrum as it was before the explicit stack, no stop nodes or weights
+    local_spectrum = defaultdict(int)
+    for child in node.children:
+        for mutation_type, count in recursive_spectrum(child, spectrum_dict).items():
+            local_spectrum[mutation_type] += count
+    for mutation in node.mutations:
+        local_spectrum[mutation[0] + mutation[-1]] += 1
+    spectrum_dict[node] = local_spectrum
+    return local_spectrum
+
+class SiteArgs:
+    #the settings find_site_splits reads from the mask_site_splits command line
+    min_total = 50
+    mask_chi = float("inf")
+
+def measure(function):
+    #(seconds, peak MB), or the error's name if it fails
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        function()
+    except RecursionError:
+        tracemalloc.stop()
+        return "RecursionError"
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return f"{elapsed:.3f}s\t{peak:.1f}MB"
+
+def main():
+    args = parse_args()
+    print("depth\tnodes\tfunction\ttime\tpeak_memory")
+    for depth in args.depths:
+        tree = ladder_tree(depth, args.seed)
+        root = tree.root
+        deepest = tree.depth_first_expansion()[-1]
+        order = TreeOrder(root)
+        table = decode_mutations(order.nodes)
+        counts = get_mutation_counts(root, table)
+        position = max(counts, key=counts.get)
+        benchmarks = [
+            ("recursive_spectrum (old)", lambda: recursive_spectrum(root, {})),
+            ("compute_mutation_spectrum", lambda: compute_mutation_spectrum(root, [], {})),
+            ("get_tips", lambda: get_tips([], root)),
+            ("get_positions", lambda: get_positions(root)),
+            ("TreeOrder", lambda: TreeOrder(root)),
+            ("get_mutation_counts", lambda: get_mutation_counts(root)),
+            ("find_site_splits", lambda: find_site_splits(position, counts[position], len(table), root, SiteArgs, {}, {}, [], order, table)),
+            ("find_node", lambda: find_node(root, deepest.id)),
+            ("compute_descendants_mutations_ratio", lambda: compute_descendants_mutations_ratio(root, {})),
+        ]
+        for name, function in benchmarks:
+            print(f"{depth}\t{len(order)}\t{name}\t{measure(function)}", flush=True)
+
+if __name__ == "__main__":
+    main()
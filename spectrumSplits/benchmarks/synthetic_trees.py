@@ -0,0 +1,134 @@
+import random
+from mutation_table import MUTATION_TYPES
+
+### small stand-ins for bte trees (id, parent, children, mutations, is_leaf) so benchmarks can build
+### trees of any shape and size without protobuf files. python's random only, so a seed gives the
+### same tree on every machine and numpy version (the benchmark references depend on it)
+
+BASES = "ACGT"
+#background spectrum: transitions four times as common as each transversion
+TRANSITIONS = {"AG", "GA", "CT", "TC"}
+
+class SyntheticNode:
+    def __init__(self, node_id, parent=None):
+        self.id = node_id
+        self.parent = parent
+        self.children = []
+        self.mutations = []
+
+    def is_leaf(self):
+        return not self.children
+
+    def update_mutations(self, mutations, update_branch_length=False):
+        self.mutations = list(mutations)
+
+class SyntheticTree:
+    def __init__(self, root):
+        self.root = root
+
+    def depth_first_expansion(self):
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.children))
+        return nodes
+
+    def breadth_first_expansion(self):
+        nodes = [self.root]
+        i = 0
+        while i < len(nodes):
+            nodes.extend(nodes[i].children)
+            i += 1
+        return nodes
+
+def add_mutations(nodes, rng, max_per_branch=3, nsites=1000):
+    for node in nodes:
+        for _ in range(rng.randint(0, max_per_branch)):
+            ref = rng.choice(BASES)
+            alt = rng.choice([base for base in BASES if base != ref])
+            node.mutations.append(f"{ref}{rng.randint(1, nsites)}{alt}")
+
+def ladder_tree(depth, seed=1, max_per_branch=3, nsites=1000):
+    '''
+    Caterpillar tree: every internal node has one tip and one internal child, so the tree is depth levels deep.
+    '''
+    rng = random.Random(seed)
+    root = SyntheticNode("node_1")
+    nodes = [root]
+    spine = root
+    for level in range(depth):
+        tip = SyntheticNode(f"tip_{level}", spine)
+        inner = SyntheticNode(f"node_{level + 2}", spine)
+        spine.children.extend([tip, inner])
+        nodes.extend([tip, inner])
+        spine = inner
+    add_mutations(nodes, rng, max_per_branch, nsites)
+    return SyntheticTree(root)
+
+def yule_topology(ntips, rng, ladderness=0.0):
+    #children lists of a random binary tree, node 0 the root. each step splits a tip: the newest one
+    #with probability ladderness (1.0 gives a caterpillar ntips levels deep), any tip otherwise
+    children = [[]]
+    tips = [0]
+    while len(tips) < ntips:
+        i = len(tips) - 1 if rng.random() < ladderness else rng.randrange(len(tips))
+        node = tips[i]
+        tips[i] = tips[-1]
+        tips.pop()
+        for _ in range(2):
+            children[node].append(len(children))
+            tips.append(len(children))
+            children.append([])
+    return children
+
+def random_tree(ntips, seed=1, ladderness=0.0, mutations_per_branch=3, nsites=1000, shifts=0, shift_strength=5.0, min_shift_tips=None):
+    '''
+    Random binary tree with ntips tips and mutations on every branch (uniform 0..2*mutations_per_branch,
+    at positions 1..nsites). Mutation types follow a background spectrum, except in shifts planted
+    clades (each of at least min_shift_tips tips, default 1% of the tips) where one random type is
+    shift_strength times more common. Clades planted inside other planted clades take over from them.
+    Internal nodes are node_1 (the root), node_2, ... in preorder, tips are tip_1, tip_2, ...
+    The planted clade ids are kept in tree.shifts.
+    '''
+    rng = random.Random(seed)
+    children = yule_topology(ntips, rng, ladderness)
+    #tips below each node, children are always numbered after their parent
+    tips = [0] * len(children)
+    for i in range(len(children) - 1, -1, -1):
+        tips[i] = sum(tips[child] for child in children[i]) if children[i] else 1
+    if min_shift_tips is None:
+        min_shift_tips = max(2, ntips // 100)
+    eligible = [i for i in range(1, len(children)) if tips[i] >= min_shift_tips]
+    planted = set(rng.sample(eligible, min(shifts, len(eligible))))
+
+    background = [4.0 if mutation_type in TRANSITIONS else 1.0 for mutation_type in MUTATION_TYPES]
+    spectra = {}
+    nodes = [None] * len(children)
+    ninternal = ntipnodes = 0
+    stack = [(0, None, background)]
+    while stack:
+        i, parent, weights = stack.pop()
+        if i in planted:
+            weights = list(weights)
+            weights[rng.randrange(len(weights))] *= shift_strength
+        if children[i]:
+            ninternal += 1
+            node = SyntheticNode(f"node_{ninternal}", parent)
+        else:
+            ntipnodes += 1
+            node = SyntheticNode(f"tip_{ntipnodes}", parent)
+        if parent is not None:
+            parent.children.append(node)
+        nodes[i] = node
+        key = tuple(weights)
+        if key not in spectra:
+            spectra[key] = [sum(weights[:k + 1]) for k in range(len(weights))]
+        for mutation_type in rng.choices(MUTATION_TYPES, cum_weights=spectra[key], k=rng.randint(0, 2 * mutations_per_branch)):
+            node.mutations.append(f"{mutation_type[0]}{rng.randint(1, nsites)}{mutation_type[1]}")
+        for child in reversed(children[i]):
+            stack.append((child, node, weights))
+    tree = SyntheticTree(nodes[0])
+    tree.shifts = sorted(nodes[i].id for i in planted)
+    return tree
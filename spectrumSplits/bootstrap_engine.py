@@ -0,0 +1,53 @@
+import numpy as np
+from tree_index import NCOLUMNS
+
+def replicate_rng(seed, replicate):
+    '''
+    Random stream for one bootstrap replicate. With a base seed, the stream only depends on (seed, replicate),
+    so a replicate comes out the same in any process, shard or machine. Without one it is freshly seeded
+    from the OS (forked workers don't share numpy's global state that way either).
+    '''
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, replicate])
+
+def parse_replicate_range(replicate_range, nreplicates):
+    #"START:END" (1 based, inclusive) to a list of replicate numbers, all of them if not given
+    if replicate_range is None:
+        return list(range(1, nreplicates + 1))
+    start, end = (int(value) for value in replicate_range.split(":"))
+    if start < 1 or end < start:
+        raise ValueError(f"Invalid replicate range {replicate_range}, expected START:END with 1 <= START <= END")
+    return list(range(start, end + 1))
+
+def draw_weights(npositions, nreplicates, rng=None, nsamples=None):
+    '''
+    Bootstrap weights for nreplicates at once, npositions x nreplicates.
+    Each column resamples nsamples (default npositions) positions with replacement, the same distribution as
+    the original create_bootstrap loop.
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    nsamples = npositions if nsamples is None else nsamples
+    return rng.multinomial(nsamples, np.full(npositions, 1.0 / npositions), size=nreplicates).T
+
+def split_spectra_matrix(index, splits, weights):
+    '''
+    Spectra of fixed splits for a batch of replicates with one sparse product.
+    Returns (splits, 13, replicates) counts, splits in the order given, stopping at the other splits
+    the same way get_spectra does.
+    '''
+    split_rows = np.array([index.index_of[split.id] for split in splits], dtype=np.int64)
+    split_mask = np.zeros(index.size, dtype=bool)
+    split_mask[split_rows] = True
+    #every node is summed into the split root whose subtree it belongs to
+    row_of_split = np.full(index.size, -1, dtype=np.int64)
+    row_of_split[split_rows] = np.arange(len(split_rows))
+    row_of_node = row_of_split[index.regions(split_mask)]
+    incidence = index.position_incidence(row_of_node, len(split_rows))
+    return np.asarray(incidence @ weights, dtype=np.int64).reshape(len(split_rows), NCOLUMNS, -1)
+
+def replicate_batches(replicates, batch_size):
+    #replicate numbers (1 based, as in the output file names) in batches of batch_size
+    replicates = list(replicates)
+    for start in range(0, len(replicates), batch_size):
+        yield replicates[start:start + batch_size]
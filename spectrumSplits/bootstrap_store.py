@@ -0,0 +1,98 @@
+import os
+import sys
+import csv
+import argparse
+import numpy as np
+from tree_index import MUTATION_TYPES
+
+### one compressed columnar file of bootstrap replicates per virus instead of a TSV per replicate.
+### columns: replicate, node_id, counts (one column per mutation type), total (including any
+### non-standard types, as Total_Mutations in the TSVs) and tips
+COLUMNS = ["replicate", "node_id", "counts", "total", "tips"]
+
+def store_filename(kind):
+    return f"bootstrap_{kind}.npz"
+
+def load_bootstrap_store(path):
+    '''
+    Every replicate in a store in one read, as a dict of column arrays (rows of all replicates together).
+    '''
+    with np.load(path) as data:
+        return {column: data[column] for column in COLUMNS}
+
+def save_bootstrap_store(path, columns):
+    #written to a temporary file renamed into place, so a store on disk is never half written
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **columns)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class BootstrapStore:
+    '''
+    Collects replicates and rewrites the store file every flush_every replicates (and on close).
+    Each rewrite goes to a temporary file that is renamed into place, so the store on disk is always
+    complete and a restart can read which replicates are already in it.
+    '''
+    def __init__(self, path, flush_every=50):
+        self.path = path
+        self.flush_every = flush_every
+        self.chunks = []
+        self.pending = 0
+        if os.path.exists(path):
+            self.chunks.append(load_bootstrap_store(path))
+
+    def replicates(self):
+        return set(int(replicate) for chunk in self.chunks for replicate in np.unique(chunk["replicate"]))
+
+    def add(self, replicate, records):
+        #records as made by spectra_records: node ids, counts, totals, tips of one replicate
+        node_ids, counts, totals, tips = records
+        self.chunks.append({"replicate": np.full(len(node_ids), replicate, dtype=np.int64), "node_id": np.array(node_ids, dtype=str),
+                            "counts": np.asarray(counts, dtype=np.int64).reshape(-1, len(MUTATION_TYPES)),
+                            "total": np.asarray(totals, dtype=np.int64), "tips": np.asarray(tips, dtype=np.int64)})
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        columns = {column: np.concatenate([chunk[column] for chunk in self.chunks]) for column in COLUMNS} if self.chunks else empty_columns()
+        self.chunks = [columns]
+        save_bootstrap_store(self.path, columns)
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+
+def empty_columns():
+    return {"replicate": np.zeros(0, dtype=np.int64), "node_id": np.zeros(0, dtype=str), "counts": np.zeros((0, len(MUTATION_TYPES)), dtype=np.int64),
+            "total": np.zeros(0, dtype=np.int64), "tips": np.zeros(0, dtype=np.int64)}
+
+def write_tsv_replicates(store_path, output_dir, kind):
+    #expand a store back into bootstrap_{i}_{kind}_output.tsv files, for tools that still read those
+    columns = load_bootstrap_store(store_path)
+    sorted_keys = sorted(MUTATION_TYPES)
+    order = [MUTATION_TYPES.index(key) for key in sorted_keys]
+    os.makedirs(output_dir, exist_ok=True)
+    for replicate in np.unique(columns["replicate"]):
+        rows = np.flatnonzero(columns["replicate"] == replicate)
+        with open(os.path.join(output_dir, f"bootstrap_{replicate}_{kind}_output.tsv"), "w", newline="") as file:
+            writer = csv.writer(file, delimiter='\t')
+            writer.writerow(["Node_ID"] + ["Total_Mutations"] + ["Number_Tips"] + ["Mutations:Tips"] + sorted_keys + ["Exemplar tips"])
+            for row in rows:
+                total = int(columns["total"][row])
+                tips = int(columns["tips"][row])
+                writer.writerow([columns["node_id"][row], total, tips, float(total) / float(tips) if tips > 0 else "NA"] + [int(columns["counts"][row, i]) / total for i in order])
+    print(f"Wrote {len(np.unique(columns['replicate']))} replicates from {store_path} to {output_dir}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Expand a bootstrap store into per-replicate TSV files.")
+    parser.add_argument("--store", type=str, required=True, help="bootstrap_splits.npz or bootstrap_spectra.npz written with --bootstrap_output npz")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory to write bootstrap_{i}_{kind}_output.tsv files to")
+    args = parser.parse_args()
+    kind = "spectra" if os.path.basename(args.store).startswith("bootstrap_spectra") else "splits"
+    write_tsv_replicates(args.store, args.output_dir, kind)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+import time
+import logging
+import json
+import shutil
+
+log = logging.getLogger(__name__)
+
+### checkpoint/resume helpers so long runs can be split over several jobs
+### everything is written to a temporary name first and renamed, so a killed job never
+### leaves a half written file behind that looks finished
+
+def atomic_write(path, text):
+    tmp_path = path + ".part"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def start_checkpoint_dir(checkpoint_dir, settings):
+    '''
+    Create checkpoint_dir, or reuse it if it was made with the same settings. If the settings changed,
+    earlier manifests, bootstrap stores, search state and split support no longer apply and are removed
+    (replicate files get overwritten).
+    '''
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    settings_path = os.path.join(checkpoint_dir, "settings.json")
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) == settings:
+                return
+        log.warning(f"Settings changed since {checkpoint_dir} was written, starting over")
+        for filename in os.listdir(checkpoint_dir):
+            if filename.endswith("_manifest.tsv") or filename in ("split_search.json", "split_support.json") or (filename.startswith("bootstrap_") and filename.endswith(".npz")):
+                os.remove(os.path.join(checkpoint_dir, filename))
+    atomic_write(settings_path, json.dumps(settings))
+
+class SearchCheckpoint:
+    '''
+    State of the main split search (accepted and finalized split ids, iteration count), saved after
+    every iteration. A saved state is only resumed if it was made with the same settings.
+    '''
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        if state["settings"] != self.settings:
+            log.warning(f"Ignoring checkpoint {self.path}, it was made with different settings")
+            return None
+        log.info(f"Resuming split search from {self.path}: {len(state['accepted'])-1} accepted splits, {len(state['finalized'])} finalized")
+        return state
+
+    def save(self, accepted_ids, finalized_ids, traversal, **extra):
+        state = {"settings": self.settings, "accepted": sorted(accepted_ids), "finalized": sorted(finalized_ids), "traversal": traversal}
+        state.update(extra)
+        atomic_write(self.path, json.dumps(state))
+
+class TimeBudget:
+    '''
+    Wall clock budget of a run in seconds, counted from when it is made. A split search asks allows()
+    after every iteration and stops once less than twice its slowest iteration so far is left, saving
+    its state (SearchCheckpoint) so the next job carries on from there.
+    '''
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.start = time.perf_counter()
+        self.slowest = 0
+        self.stopped = False
+
+    def remaining(self):
+        return self.seconds - (time.perf_counter() - self.start)
+
+    def allows(self, iteration_seconds):
+        #false (and stopped from then on) when another iteration might not finish in time
+        self.slowest = max(self.slowest, iteration_seconds)
+        if self.remaining() < 2 * self.slowest:
+            self.stopped = True
+        return not self.stopped
+
+def manifest_path(checkpoint_dir, kind):
+    return os.path.join(checkpoint_dir, f"{kind}_manifest.tsv")
+
+def completed_replicates(checkpoint_dir, kind):
+    #replicates listed in the manifest whose output file is still there
+    path = manifest_path(checkpoint_dir, kind)
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 2 and os.path.exists(os.path.join(checkpoint_dir, fields[1])):
+                done.add(int(fields[0]))
+    return done
+
+def record_replicate(checkpoint_dir, kind, replicate, filename):
+    #only called once the replicate file itself has been renamed into place
+    with open(manifest_path(checkpoint_dir, kind), "a") as f:
+        f.write(f"{replicate}\t{filename}\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def link_replicates(checkpoint_dir, output_dir, filenames):
+    #hard link finished replicates into the output directory, copying if linking isn't possible
+    for filename in filenames:
+        source = os.path.join(checkpoint_dir, filename)
+        target = os.path.join(output_dir, filename)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
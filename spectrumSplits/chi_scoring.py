@@ -0,0 +1,103 @@
+import numpy as np
+
+#candidates scored before the bound is used to rule the others out
+BOUND_FIRST = 64
+
+def contingency_chi2(observed):
+    '''
+    chi2_contingency statistic for a stack of tables, observed shape (n, 2, k) with no all-zero columns.
+    Follows scipy step for step (including Yates' correction when k == 2) so the values are
+    bit for bit the same as calling chi2_contingency on each table.
+    Tables with an empty row have no defined statistic and come back as 0.
+    '''
+    row_sums = observed.sum(axis=2, keepdims=True)
+    column_sums = observed.sum(axis=1, keepdims=True)
+    totals = observed.sum(axis=(1, 2), keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = row_sums * column_sums / totals
+        if observed.shape[2] == 2:
+            diff = expected - observed
+            observed = observed + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+        terms = (observed - expected) ** 2 / expected
+        #each table is summed on its own as one contiguous run, the same way scipy sums it
+        chi = terms.reshape(len(terms), -1).sum(axis=1)
+    #chi2_contingency raises on a zero expected frequency, those candidates are skipped instead
+    chi[(row_sums == 0).any(axis=(1, 2))] = 0
+    return chi
+
+def chi_upper_bound(below, root_spectrum):
+    '''
+    Upper bound on the chi value of each candidate, from its total (a) and the complement's (b) over the
+    types the split root has, and the root's type counts c. For a 2 x k table
+        chi = N^2 / (a b) * (sum_j x_j^2 / c_j - a^2 / N),  N = a + b, x_j the candidate's counts,
+    and with 0 <= x_j <= min(c_j, a), x_j^2 / c_j <= x_j * min(c_j, a) / c_j. Filling the types with the
+    largest min(c_j, a) / c_j first bounds the sum: every type with c_j <= a counts fully, the rest of a goes
+    into the smallest type with c_j > a. Yates' correction only lowers chi, so it holds for k == 2 as well.
+    '''
+    columns = root_spectrum > 0
+    counts = np.sort(root_spectrum[columns]).astype(float)
+    a = below[:, columns].sum(axis=1).astype(float)
+    N = float(counts.sum())
+    b = N - a
+    #types small enough to be filled completely, and the smallest one that isn't
+    nfull = np.searchsorted(counts, a, side="right")
+    full = np.concatenate([[0], np.cumsum(counts)])[nfull]
+    next_count = np.append(counts, np.inf)[nfull]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fill = np.minimum(full + np.maximum(a - full, 0) * a / next_count, a)
+        bound = N * N / (a * b) * (fill - a * a / N)
+    #empty rows score 0. a little slack so rounding in the chi sum can't go over the bound
+    bound[(a <= 0) | (b <= 0)] = 0
+    return bound * (1 + 1e-9) + 1e-9
+
+def score_rows(below, above, kept_columns, rows):
+    #contingency_chi2 of the given candidates, grouped so every table in a block has the same shape
+    chi = np.zeros(len(rows))
+    nkept = kept_columns[rows].sum(axis=1)
+    for k in np.unique(nkept):
+        if k < 2:
+            continue
+        block = rows[nkept == k]
+        columns = kept_columns[block]
+        observed = np.stack([below[block][columns].reshape(-1, k), above[block][columns].reshape(-1, k)], axis=1)
+        chi[nkept == k] = contingency_chi2(observed)
+    return chi
+
+def score_splits(below, below_totals, root_spectrum, root_total, min_mutations, min_chi=None, bounded=False):
+    '''
+    Score every candidate node of a split root at once.
+    below is (n, 12) type counts of each candidate subtree and root_spectrum the (12,) counts of the
+    whole split root, totals include any non-standard types. Returns (max_chi, row) where row is the
+    first candidate reaching max_chi, or (0, None), the same pick as the loop in find_splits.
+    With bounded, candidates are scored largest chi_upper_bound first and the rest only if their bound
+    can still reach the best chi so far, giving the same pick. Candidates whose bound can't go over
+    min_chi aren't scored either, so when no candidate can, max_chi may come back lower than the
+    true maximum (but still not over min_chi). The batched chi is cheap enough that bounding doesn't pay
+    for itself on trees up to 16000 tips (bench_stages.py), so callers leave it off unless asked.
+    '''
+    chi = np.zeros(len(below))
+    scored = (below_totals >= min_mutations) & (root_total - below_totals >= min_mutations)
+    above = root_spectrum - below
+    #a mutation type with zero counts on BOTH sides carries no information, and
+    #chi2_contingency raises on it. dropping it per node gives exactly the same chi value,
+    #and nodes with fewer than two observed types have nothing to compare
+    kept_columns = (below + above) > 0
+    if not bounded:
+        rows = np.flatnonzero(scored)
+        chi[rows] = score_rows(below, above, kept_columns, rows)
+    else:
+        bound = chi_upper_bound(below, root_spectrum)
+        if min_chi is not None:
+            scored &= bound > min_chi
+        rows = np.flatnonzero(scored)
+        #the most promising candidates first, then everything that could still match or beat them
+        first = rows[np.argsort(-bound[rows], kind="stable")[:BOUND_FIRST]]
+        chi[first] = score_rows(below, above, kept_columns, first)
+        done = np.zeros(len(chi), dtype=bool)
+        done[first] = True
+        rest = rows[(bound[rows] >= chi[first].max(initial=0)) & ~done[rows]]
+        chi[rest] = score_rows(below, above, kept_columns, rest)
+    if len(chi) == 0 or chi.max() <= 0:
+        return 0, None
+    best = int(np.argmax(chi))
+    return chi[best], best
@@ -0,0 +1,127 @@
+import sys
+import argparse
+from tree_cache import load_tree
+
+### smaller analysis copy of a tree, without internal nodes whose branch carries no mutations.
+### a zero-mutation node with one child has the same subtree spectrum, tips and site counts as that child,
+### and the child is always scored first, so dropping it ("unary") changes no split, spectrum or mask.
+### "zero" also folds zero-mutation nodes with several children into their parent (a polytomy, as
+### matUtils collapses them), so a split can no longer fall on a branch no mutation supports.
+### kept nodes keep their ids, and merged maps every dropped id to the kept node standing in for it
+
+COLLAPSE_MODES = ["none", "unary", "zero"]
+
+class CollapsedNode:
+    '''
+    Node of a CollapsedTree: id, parent, children, is_leaf() and the mutations of the node it stands
+    for (source), read and updated through to it. depth is the source node's depth in the whole tree.
+    '''
+    __slots__ = ("id", "parent", "children", "depth", "source", "tree", "index")
+
+    def __init__(self, source, parent, depth):
+        self.source = source
+        self.id = source.id
+        self.parent = parent
+        self.children = []
+        self.depth = depth
+        #cached tree nodes keep their place in the cache arrays, so decode_mutations still reads them from there
+        self.tree = getattr(source, "tree", None)
+        self.index = getattr(source, "index", None)
+
+    @property
+    def mutations(self):
+        return self.source.mutations
+
+    def update_mutations(self, mutations, update_branch_length=False):
+        self.source.update_mutations(mutations, update_branch_length=update_branch_length)
+
+    def is_leaf(self):
+        return not self.children
+
+class CollapsedTree:
+    '''
+    Read side of a MATree (root, breadth_first_expansion, depth_first_expansion, get_node, get_leaves)
+    with zero-mutation internal nodes dropped as mode says ("unary" or "zero"). The root and the tips
+    are always kept. original is the tree it was made from and original_size its number of nodes.
+    '''
+    def __init__(self, tree, mode="unary"):
+        if mode not in COLLAPSE_MODES[1:]:
+            raise ValueError(f"Unknown collapse mode {mode}, expected one of {', '.join(COLLAPSE_MODES[1:])}")
+        self.original = tree
+        self.mode = mode
+        self.nodes = []
+        self.merged = {}
+        self.original_size = 0
+        #dropped single child nodes, resolved to the kept node below them once the tree is built
+        chains = []
+        #(source node, collapsed parent, depth in the original tree)
+        stack = [(tree.root, None, 0)]
+        while stack:
+            source, parent, depth = stack.pop()
+            self.original_size += 1
+            if parent is not None and source.children and not source.mutations and (len(source.children) == 1 or mode == "zero"):
+                if len(source.children) == 1:
+                    chains.append(source)
+                else:
+                    self.merged[source.id] = parent.id
+                node = parent
+            else:
+                node = CollapsedNode(source, parent, depth)
+                if parent is not None:
+                    parent.children.append(node)
+                self.nodes.append(node)
+            for child in reversed(source.children):
+                stack.append((child, node, depth + 1))
+        #deepest first, so whatever stands in for the child is already known
+        for source in reversed(chains):
+            child = source.children[0]
+            self.merged[source.id] = self.merged.get(child.id, child.id)
+        self.root = self.nodes[0]
+        self.by_id = None
+
+    def depth_first_expansion(self):
+        #nodes are stored in preorder
+        return list(self.nodes)
+
+    def breadth_first_expansion(self):
+        expansion = [self.root]
+        i = 0
+        while i < len(expansion):
+            expansion.extend(expansion[i].children)
+            i += 1
+        return expansion
+
+    def get_node(self, node_id):
+        #dropped nodes give the node standing in for them
+        if self.by_id is None:
+            self.by_id = {node.id: node for node in self.nodes}
+        return self.by_id[self.merged.get(node_id, node_id)]
+
+    def get_leaves(self):
+        return [node for node in self.nodes if node.is_leaf()]
+
+    def get_leaves_ids(self):
+        return [node.id for node in self.get_leaves()]
+
+    def summary(self):
+        return f"Collapsed {len(self.merged)} of {self.original_size} nodes ({self.mode}), {len(self.nodes)} left"
+
+def write_collapse_map(tree, path):
+    #dropped node id -> id of the kept node standing in for it, one per line
+    with open(path, "w") as f:
+        for node_id, kept_id in tree.merged.items():
+            f.write(f"{node_id}\t{kept_id}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Count the nodes collapsing would drop from a tree and write which kept node stands in for each (spectrumSplits.py and mask_site_splits.py collapse with --collapse).")
+    parser.add_argument("--input_tree", type=str, required=True, help="Input tree file (protobuf format)")
+    parser.add_argument("--mode", type=str, default="unary", choices=COLLAPSE_MODES[1:], help="'unary' drops zero-mutation nodes with one child (results unchanged), 'zero' every zero-mutation internal node")
+    parser.add_argument("--map_output", type=str, default=None, help="TSV of dropped node id and the kept node id standing in for it")
+    args = parser.parse_args()
+    tree = CollapsedTree(load_tree(args.input_tree), args.mode)
+    print(tree.summary(), file=sys.stderr)
+    if args.map_output is not None:
+        write_collapse_map(tree, args.map_output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import re
+import sys
+import filecmp
+import argparse
+import numpy as np
+from checkpoint import link_replicates
+from bootstrap_store import COLUMNS, store_filename, load_bootstrap_store, save_bootstrap_store
+
+### combine bootstrap replicates run as separate shards (spectrumSplits.py --replicate_range) into one
+### directory: bootstrap_{i}_{kind}_output.tsv files as process_bootstraps.py reads them, and the
+### bootstrap_{kind}.npz stores of shards run with --bootstrap_output npz as one store per kind
+
+REPLICATE_FILE = re.compile(r"^bootstrap_(\d+)_(splits|spectra)_output\.tsv$")
+KINDS = ["splits", "spectra"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge bootstrap replicate shards into one bootstrap directory.")
+    parser.add_argument("--shard_dirs", type=str, nargs="+", required=True, help="Bootstrap (or checkpoint) directories written by each shard")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory to collect every replicate in")
+    parser.add_argument("--nreplicates", type=int, default=0, help="Expected number of replicates of each kind in --kinds, to report any missing (0 to skip the check)")
+    parser.add_argument("--kinds", type=str, nargs="+", default=KINDS, choices=KINDS, help="Kinds of replicate the shards were run with, each is checked by --nreplicates even if none were found (leave out spectra for shards run without --bootstrap_spectra)")
+    return parser.parse_args()
+
+def collect_replicates(shard_dirs):
+    #(kind, replicate) -> shard directory. a replicate found twice must be the same file, as it is
+    #when shards overlap with the same --seed
+    found = {}
+    for shard_dir in shard_dirs:
+        for filename in sorted(os.listdir(shard_dir)):
+            match = REPLICATE_FILE.match(filename)
+            if not match:
+                continue
+            key = (match.group(2), int(match.group(1)))
+            if key in found:
+                if not filecmp.cmp(os.path.join(found[key], filename), os.path.join(shard_dir, filename), shallow=False):
+                    raise ValueError(f"{filename} differs between {found[key]} and {shard_dir}, were the shards run with different seeds?")
+                continue
+            found[key] = shard_dir
+    return found
+
+def collect_stores(shard_dirs):
+    '''
+    kind -> the columns of every shard's bootstrap_{kind}.npz together, rows ordered by replicate.
+    A replicate in the stores of two shards is a ValueError, the shards' replicate ranges overlapped.
+    '''
+    merged = {}
+    for kind in KINDS:
+        chunks = []
+        #replicate -> shard directory whose store has it
+        owner = {}
+        for shard_dir in shard_dirs:
+            path = os.path.join(shard_dir, store_filename(kind))
+            if not os.path.exists(path):
+                continue
+            columns = load_bootstrap_store(path)
+            for replicate in np.unique(columns["replicate"]).tolist():
+                if replicate in owner:
+                    raise ValueError(f"{kind} replicate {replicate} is in the stores of both {owner[replicate]} and {shard_dir}, did the shards' --replicate_range overlap?")
+                owner[replicate] = shard_dir
+            chunks.append(columns)
+        if chunks:
+            columns = {column: np.concatenate([chunk[column] for chunk in chunks]) for column in COLUMNS}
+            #rows of a replicate stay in the order its shard wrote them
+            order = np.argsort(columns["replicate"], kind="stable")
+            merged[kind] = {column: values[order] for column, values in columns.items()}
+    return merged
+
+def main():
+    args = parse_args()
+    found = collect_replicates(args.shard_dirs)
+    stores = collect_stores(args.shard_dirs)
+    if not found and not stores:
+        print(f"No bootstrap replicates (TSVs or {' or '.join(store_filename(kind) for kind in KINDS)}) in {', '.join(args.shard_dirs)}", file=sys.stderr)
+        sys.exit(1)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for (kind, replicate), shard_dir in sorted(found.items()):
+        link_replicates(shard_dir, args.output_dir, [f"bootstrap_{replicate}_{kind}_output.tsv"])
+    for kind, columns in stores.items():
+        save_bootstrap_store(os.path.join(args.output_dir, store_filename(kind)), columns)
+    incomplete = False
+    for kind in args.kinds:
+        replicates = set(replicate for found_kind, replicate in found if found_kind == kind)
+        stored = set(np.unique(stores[kind]["replicate"]).tolist()) if kind in stores else set()
+        if replicates & stored:
+            raise ValueError(f"{kind} replicates {','.join(str(replicate) for replicate in sorted(replicates & stored))} are both in TSVs and in a store")
+        replicates |= stored
+        print(f"Merged {len(replicates)} {kind} replicates into {args.output_dir}" + (f" ({len(stored)} in {store_filename(kind)})" if stored else ""), file=sys.stderr)
+        if args.nreplicates > 0:
+            missing = sorted(set(range(1, args.nreplicates + 1)) - replicates)
+            if missing:
+                print(f"Missing {len(missing)} {kind} replicates: {','.join(str(replicate) for replicate in missing)}", file=sys.stderr)
+                incomplete = True
+    if incomplete:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
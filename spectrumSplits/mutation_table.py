@@ -0,0 +1,89 @@
+import numpy as np
+
+#the 12 single nucleotide mutation types, in the column order used everywhere below
+MUTATION_TYPES = ["AC","AG","AT","CA","CG","CT","GA","GC","GT","TA","TC","TG"]
+TYPE_COLUMN = {mutation_type: i for i, mutation_type in enumerate(MUTATION_TYPES)}
+#anything that isn't one of the 12 types (ambiguous bases etc) still counts toward
+#subtree totals in compute_mutation_spectrum, so it gets its own column
+OTHER_COLUMN = len(MUTATION_TYPES)
+NCOLUMNS = OTHER_COLUMN + 1
+
+#(from base, to base) codes -> type column
+TYPE_OF_BASES = np.full((256, 256), OTHER_COLUMN, dtype=np.int64)
+for mutation_type, column in TYPE_COLUMN.items():
+    TYPE_OF_BASES[ord(mutation_type[0]), ord(mutation_type[1])] = column
+
+class MutationTable:
+    '''
+    Mutations of a list of nodes decoded once into integer arrays: owning node (index into that list),
+    position, and from/to base as their ASCII codes. Rows are grouped by node, node i's mutations are
+    rows offsets[i]:offsets[i+1], in the same order as node.mutations.
+    '''
+    def __init__(self, offsets, pos, ref, alt, ids=None):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.pos = np.asarray(pos, dtype=np.int64)
+        self.ref = np.asarray(ref, dtype=np.uint8)
+        self.alt = np.asarray(alt, dtype=np.uint8)
+        self.nnodes = len(self.offsets) - 1
+        self.node = np.repeat(np.arange(self.nnodes), np.diff(self.offsets))
+        self.ids = ids
+        self.index_of = {node_id: i for i, node_id in enumerate(ids)} if ids is not None else None
+
+    def __len__(self):
+        return len(self.pos)
+
+    def rows(self, i):
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def rows_of(self, node_id):
+        return self.rows(self.index_of[node_id])
+
+    def branch_lengths(self):
+        return np.diff(self.offsets)
+
+    def types(self):
+        #type column (MUTATION_TYPES order, OTHER_COLUMN for anything else) of every mutation
+        return TYPE_OF_BASES[self.ref, self.alt]
+
+    def position_counts(self):
+        #(positions, number of mutations at each), positions sorted
+        return np.unique(self.pos, return_counts=True)
+
+    def mutation_strings(self, i):
+        rows = self.rows(i)
+        return [f"{chr(ref)}{pos}{chr(alt)}" for ref, pos, alt in zip(self.ref[rows].tolist(), self.pos[rows].tolist(), self.alt[rows].tolist())]
+
+    def take(self, order, ids=None):
+        #a table of the nodes at the given indices, in that order
+        order = np.asarray(order, dtype=np.int64)
+        lengths = self.branch_lengths()[order]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        rows = np.repeat(self.offsets[order] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return MutationTable(offsets, self.pos[rows], self.ref[rows], self.alt[rows], ids)
+
+    def without(self, removed):
+        #a table of the same nodes without the rows where removed (one bool per row) is true, what
+        #decode_mutations gives once those mutations are taken off the nodes
+        keep = ~np.asarray(removed, dtype=bool)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(self.node[keep], minlength=self.nnodes))]).astype(np.int64)
+        return MutationTable(offsets, self.pos[keep], self.ref[keep], self.alt[keep], self.ids)
+
+def decode_mutations(nodes):
+    '''
+    MutationTable of nodes, in the order given. Nodes of a cached tree (tree_cache.py) are taken straight
+    from the cached arrays, other nodes have their mutation strings parsed, once.
+    '''
+    nodes = list(nodes)
+    ids = [node.id for node in nodes]
+    tree = getattr(nodes[0], "tree", None) if nodes else None
+    if tree is not None and hasattr(tree, "arrays"):
+        arrays = tree.arrays
+        table = MutationTable(arrays["mut_offsets"], arrays["mut_pos"], arrays["mut_ref"], arrays["mut_alt"])
+        return table.take([node.index for node in nodes], ids)
+    mutations = [mutation for node in nodes for mutation in node.mutations]
+    offsets = np.concatenate([[0], np.cumsum([len(node.mutations) for node in nodes])]).astype(np.int64)
+    return MutationTable(offsets,
+                         np.fromiter((int(mutation[1:-1]) for mutation in mutations), dtype=np.int64, count=len(mutations)),
+                         np.fromiter((ord(mutation[0]) for mutation in mutations), dtype=np.uint8, count=len(mutations)),
+                         np.fromiter((ord(mutation[-1]) for mutation in mutations), dtype=np.uint8, count=len(mutations)),
+                         ids)
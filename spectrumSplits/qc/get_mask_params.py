@@ -1,24 +1,25 @@
 import numpy as np
 from scipy.stats import chi2
+import os
+import sys
 import argparse
-import bte
+#shared helpers live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from tree_cache import load_tree
+from mutation_table import decode_mutations
 
 def bte_calculate(tree_file):
-    tree = bte.MATree(tree_file)
+    tree = load_tree(tree_file)
     print(tree)
     tree.breadth_first_expansion()
     print('hi')
     internal_nodes = []
-    mutations = {}
     #internal_nodes = [node.id for node in tree.breadth_first_expansion() if not node.is_leaf()]
-    for node in tree.breadth_first_expansion():
-        for mut in node.mutations:
-            pos = mut[1:-1]
-            #print(mut, pos)
-            if pos not in mutations:
-                mutations[pos] = 1
-            else:
-                mutations[pos] += 1
+    nodes = tree.breadth_first_expansion()
+    #mutations per position, counted on the decoded mutation table
+    positions, counts = decode_mutations(nodes).position_counts()
+    mutations = {str(pos): count for pos, count in zip(positions.tolist(), counts.tolist())}
+    for node in nodes:
         if not node.is_leaf():
             internal_nodes.append(node.id)
     #print(internal_nodes)
@@ -1,12 +1,25 @@
+import os
 import bte
 import sys
+import csv
 import argparse
 from scipy.stats import chi2_contingency
-from collections import defaultdict
-from multiprocessing import Process, Manager
+from collections import defaultdict, Counter
+from multiprocessing import get_context
 import re
 import numpy as np
 from scipy.stats import chi2
+#shared helpers live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from mutation_table import decode_mutations
+from traversal import preorder, TreeOrder
+from collapse_tree import CollapsedTree, COLLAPSE_MODES
+from chi_scoring import contingency_chi2
+
+#nodes x sites cells scan_site_splits scores at once (a few hundred bytes each while scoring)
+SCAN_BLOCK_CELLS = 1 << 20
+#columns of the mask plan, one row per site masked in an iteration
+PLAN_COLUMNS = ["site", "node_id", "direction", "chi", "iteration", "mutations_removed"]
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Process a phylogenetic tree to find splits, compute spectra, and mask mutations above/below nodes.")
@@ -16,10 +29,15 @@ def parse_args():
     #parser.add_argument("--mutation_list_output", required=False, help="If desired, output file listing finaled masked mutations.")
     parser.add_argument("--min_total", type=int, default=500, help="Minimum mutation count to accept a split")
     parser.add_argument("--min_count", type=int, default=50, help="Minimum mutation count to check a site")
-    parser.add_argument("--nthreads", type=int, default=100, help="Number of concurrent threads for processing")
+    parser.add_argument("--nthreads", type=int, default=100, help="Number of worker processes, forked once per iteration (scan splits the sites between them)")
     #it might be maximum chi?
     parser.add_argument("--mask_chi", type=float, default=5000, help="Minimum chi2 value for masking mutation below/above a node")
     parser.add_argument("--calculate_max_chi", action="store_true", help="Calculate minimum chi-square value based on tree size")
+    parser.add_argument("--engine", type=str, default="per_site", choices=["per_site", "scan"], help="'per_site' runs find_site_splits for every site on a pool of nthreads workers. 'scan' scores all sites against all nodes in vectorized blocks, same masks in a fraction of the time")
+    parser.add_argument("--collapse", type=str, default="none", choices=COLLAPSE_MODES, help="Look for site splits on a copy of the tree without internal nodes that carry no mutations (collapse_tree.py), masks still go on the full tree. 'unary' (single child nodes only) finds the same masks")
+    parser.add_argument("--mask_plan", type=str, default=None, help="Output TSV of every mask applied (site, node id, direction, chi, iteration, mutations removed), default next to the output tree as <output_tree without .pb.gz>.mask_plan.tsv")
+    parser.add_argument("--dry_run", action="store_true", help="Work out the masks and write the mask plan without saving the masked tree")
+    parser.add_argument("--apply_plan", type=str, default=None, help="Apply a mask plan (written by an earlier run, rows can be dropped or edited, e.g. keeping only chi above a stricter threshold) to the input tree in one pass instead of looking for site splits")
     parser.add_argument("--calculate_min_mutations", action="store_true", help="If minimum count of mutations is unknown, default is likely too high. Flag this to estimate a reasonable minimum count based on tree size")
     return parser.parse_args()
 
@@ -30,62 +48,47 @@ def get_position_from_mutation(mutation):
     return None
 
 
-def get_mutation_counts(node):
+def get_mutation_counts(node, table=None):
     '''
     Get counts of mutations at each position in the tree.
     Position focused, not mutation type.
+    Counted on the decoded mutation table (table, if already made for this subtree).
     '''
-    mutation_counts = defaultdict(int)
-    def traverse_tree(node):
-        for mutation in node.mutations:
-            pos = get_position_from_mutation(mutation)
-            if pos is not None:
-                mutation_counts[pos] += 1
-        for child in node.children:
-            traverse_tree(child)
-    traverse_tree(node)
-    return dict(mutation_counts)
-
-#for multiprocessing
-def process_mutation(tree, position, count, total_mutations, args, mask_below_dict, mask_above_dict, chi_list):
-    find_site_splits(position, count, total_mutations, tree.root, args, mask_below_dict, mask_above_dict, chi_list)
-
-#for multiprocessing
-def run_in_process(tree, position, count, total_mutations, args, mask_below_dict, mask_above_dict, chi_list):
-    p = Process(target=process_mutation, args=(tree, position, count, total_mutations, args, mask_below_dict, mask_above_dict, chi_list))
-    p.start()
-    return p
-
-def find_site_splits(position, mutation_count, total_mutations, root, args, mask_below_dict, mask_above_dict, chi_list):
+    if table is None:
+        table = decode_mutations(preorder(node))
+    positions, counts = table.position_counts()
+    return dict(zip(positions.tolist(), counts.tolist()))
+
+def find_site_splits(position, mutation_count, total_mutations, root, args, mask_below_dict, mask_above_dict, chi_list, order=None, table=None):
     #look for node where mutation is enriched below or above node?
-    mutation_memo = {}
-    total_memo = {}
+    #order (TreeOrder of root) and table (decode_mutations(order.nodes)) are made once per iteration by main,
+    #per node counts come from the table rather than parsing every mutation again for every site
+    if order is None:
+        order = TreeOrder(root)
+    if table is None:
+        table = decode_mutations(order.nodes)
+    position, max_chi, node, mask_direction = best_site_split(position, mutation_count, total_mutations, order, table, args.min_total)
+    record_site_split(position, max_chi, order.nodes[node].id, mask_direction, args.mask_chi, mask_below_dict, mask_above_dict, chi_list)
+
+def best_site_split(position, mutation_count, total_mutations, order, table, min_total):
+    #best split of one site as a (position, max_chi, node index in order, direction) record
+    site_counts = np.bincount(table.node[table.pos == position], minlength=table.nnodes).tolist()
+    totals = table.branch_lengths().tolist()
+    parent = order.parent.tolist()
     max_chi = 0
-    max_node = root
+    max_node = 0
     mask_direction = 'below'
 
-    #this is very similar to spectrumSplits.py 
-    def traverse_and_count(node):
-        #takes variables from outer function
-        nonlocal max_chi, max_node, mask_direction
-
-        if node.id in mutation_memo:
-            return mutation_memo[node.id], total_memo[node.id]
-
-        #sum mutations at this position in this node
-        mutation_occurrences = sum(1 for mut in node.mutations if get_position_from_mutation(mut) == position)
-        total_descendant_mutations = len(node.mutations)
-
-        #for each descending node, also sum mutations at position
-        # add descendant totals to node totals
-        for child in node.children:
-            child_mut_count, child_total = traverse_and_count(child)
-            mutation_occurrences += child_mut_count
-            total_descendant_mutations += child_total
-
-        #tracking all mutations as well as mutations at this position
-        mutation_memo[node.id] = mutation_occurrences
-        total_memo[node.id] = total_descendant_mutations
+    #this is very similar to spectrumSplits.py
+    #children come before parents in postorder, so each node's counts are complete when it is reached
+    #and are then added to its parent. visiting order is the same as the old recursive walk, so ties go the same way
+    for i in order.post.tolist():
+        #mutations at this position (and all mutations) in this node's subtree
+        mutation_occurrences = site_counts[i]
+        total_descendant_mutations = totals[i]
+        if parent[i] >= 0:
+            site_counts[parent[i]] += mutation_occurrences
+            totals[parent[i]] += total_descendant_mutations
 
         # subtract tree total from total at this node to get above-node totals
         snps_above = mutation_count - mutation_occurrences
@@ -96,7 +99,7 @@ def find_site_splits(position, mutation_count, total_mutations, root, args, mask
         rate_above = snps_above / total_above if total_above > 0 else 0
 
         #i probably need to adjust args
-        if total_above > args.min_total and total_descendant_mutations > args.min_total:
+        if total_above > min_total and total_descendant_mutations > min_total:
             observed = [
                 [total_above - snps_above, snps_above],
                 [total_descendant_mutations - mutation_occurrences, mutation_occurrences]
@@ -105,72 +108,265 @@ def find_site_splits(position, mutation_count, total_mutations, root, args, mask
             #i need to adjust max chi threshold
             if chi2 > max_chi:
                 max_chi = chi2
-                max_node = node
+                max_node = i
                 mask_direction = 'below' if rate_below >= rate_above else 'above'
-        return mutation_occurrences, total_descendant_mutations
+    return position, max_chi, max_node, mask_direction
 
-    traverse_and_count(root)
-    if max_chi > args.mask_chi:
+def record_site_split(position, max_chi, node_id, mask_direction, mask_chi, mask_below_dict, mask_above_dict, chi_list):
+    #the best split of one site, masked if it goes over mask_chi
+    if max_chi > mask_chi:
         if mask_direction == 'below':
-            current = mask_below_dict.get(max_node.id, [])
+            current = mask_below_dict.get(node_id, [])
             current.append(position)
-            mask_below_dict[max_node.id] = current
+            mask_below_dict[node_id] = current
         else:
-            current = mask_above_dict.get(max_node.id, [])
+            current = mask_above_dict.get(node_id, [])
             current.append(position)
-            mask_above_dict[max_node.id] = current
-    chi_list.append((position, max_chi, max_node.id, mask_direction))
+            mask_above_dict[node_id] = current
+    chi_list.append((position, max_chi, node_id, mask_direction))
+
+def scan_site_splits(mutation_counts, total_mutations, order, table, min_total):
+    '''
+    find_site_splits for every site in mutation_counts (position -> count) at once, as
+    (position, max_chi, node index in order, direction) records: the same node (the first in postorder
+    reaching the largest chi, the root and 'below' if no chi goes over 0) and the same chi values.
+    Counts of every site below every node come from prefix sums over the preorder (a subtree is the
+    range i:end[i]), and the 2x2 chi values (with scipy's Yates correction) from chi_scoring, a block
+    of sites at a time.
+    '''
+    positions = np.array(sorted(mutation_counts), dtype=np.int64)
+    site_totals = np.array([mutation_counts[position] for position in positions.tolist()], dtype=np.int64)
+
+    def subtree_sums(values):
+        prefix = np.concatenate([np.zeros((1,) + values.shape[1:], dtype=np.int64), np.cumsum(values, axis=0)])
+        return prefix[order.end] - prefix[:-1]
+
+    below_totals = subtree_sums(table.branch_lengths())
+    above_totals = total_mutations - below_totals
+    #nodes that can be a split, in postorder so argmax picks the node the loop in find_site_splits would
+    rows = order.post[((above_totals > min_total) & (below_totals > min_total))[order.post]]
+    if len(rows) == 0:
+        return [(position, 0, 0, 'below') for position in positions.tolist()]
+    #column of each mutation's site, mutations at other sites aren't scanned
+    column = np.searchsorted(positions, table.pos)
+    scanned = column < len(positions)
+    scanned[scanned] = positions[column[scanned]] == table.pos[scanned]
+
+    records = []
+    block = max(1, SCAN_BLOCK_CELLS // len(rows))
+    for start in range(0, len(positions), block):
+        width = min(block, len(positions) - start)
+        in_block = scanned & (column >= start) & (column < start + width)
+        counts = np.bincount(table.node[in_block] * width + column[in_block] - start, minlength=len(order) * width).reshape(len(order), width)
+        below = subtree_sums(counts)[rows]
+        above = site_totals[start:start + width] - below
+        #tables as find_site_splits lays them out, [[other above, site above], [other below, site below]]
+        observed = np.stack([np.stack([above_totals[rows][:, None] - above, above], axis=-1),
+                             np.stack([below_totals[rows][:, None] - below, below], axis=-1)], axis=-2)
+        chi = contingency_chi2(observed.reshape(-1, 2, 2)).reshape(len(rows), width)
+        #find_site_splits never gets a chi for tables chi2_contingency can't score (no mutations outside the site)
+        chi[np.isnan(chi)] = 0
+        best = chi.argmax(axis=0)
+        for j, position in enumerate(positions[start:start + width].tolist()):
+            max_chi = chi[best[j], j]
+            if not max_chi > 0:
+                records.append((position, 0, 0, 'below'))
+                continue
+            node = int(rows[best[j]])
+            occurrences, snps_above = int(below[best[j], j]), int(above[best[j], j])
+            rate_below = occurrences / int(below_totals[node]) if below_totals[node] > 0 else 0
+            rate_above = snps_above / int(above_totals[node]) if above_totals[node] > 0 else 0
+            records.append((position, max_chi, node, 'below' if rate_below >= rate_above else 'above'))
+    return records
+
+### worker pool for both engines. the tree order and mutation table reach the workers through fork when the
+### pool starts (once per iteration, masking remakes the table), so nothing but sites and records is pickled.
+### workers only return (position, max_chi, node index, direction) records, and the parent merges them into
+### the masks in site order, so the masks and chi list don't depend on which worker finished first
+_sites = {}
+
+def init_site_worker(order, table, total_mutations, min_total):
+    _sites["order"] = order
+    _sites["table"] = table
+    _sites["total_mutations"] = total_mutations
+    _sites["min_total"] = min_total
+
+def run_site_task(site):
+    position, count = site
+    return best_site_split(position, count, _sites["total_mutations"], _sites["order"], _sites["table"], _sites["min_total"])
+
+def run_scan_task(mutation_counts):
+    return scan_site_splits(mutation_counts, _sites["total_mutations"], _sites["order"], _sites["table"], _sites["min_total"])
+
+def site_records(task, tasks, order, table, total_mutations, min_total, nthreads, chunksize=1):
+    #[task(t) for t in tasks] over up to nthreads forked workers, results in the order of tasks
+    with get_context("fork").Pool(min(nthreads, len(tasks)), initializer=init_site_worker, initargs=(order, table, total_mutations, min_total)) as pool:
+        return pool.map(task, tasks, chunksize=chunksize)
+
+def merge_site_records(records, order, mask_chi):
+    #masks and chi list from (position, max_chi, node index, direction) records
+    mask_below_dict, mask_above_dict, chi_list = {}, {}, []
+    for position, max_chi, node, mask_direction in records:
+        record_site_split(position, max_chi, order.nodes[node].id, mask_direction, mask_chi, mask_below_dict, mask_above_dict, chi_list)
+    return mask_below_dict, mask_above_dict, chi_list
+
+def scan_masks(mutation_counts, total_mutations, args, order, table):
+    #masks and chi list of every site, from scan_site_splits, the sites split into one chunk per worker
+    positions = sorted(mutation_counts)
+    nchunks = max(1, min(args.nthreads, len(positions)))
+    if nchunks == 1:
+        records = scan_site_splits(mutation_counts, total_mutations, order, table, args.min_total)
+    else:
+        size = -(-len(positions) // nchunks)
+        chunks = [{position: mutation_counts[position] for position in positions[start:start + size]} for start in range(0, len(positions), size)]
+        records = [record for chunk in site_records(run_scan_task, chunks, order, table, total_mutations, args.min_total, args.nthreads) for record in chunk]
+    return merge_site_records(records, order, args.mask_chi)
+
+def per_site_masks(mutation_counts, total_mutations, args, order, table):
+    #masks and chi list of every site, find_site_splits one site at a time on the worker pool
+    #this is all of the mutations that occur more than min_count times, 
+    #these ones are checked for unlikely distributions of mutations, and 
+    # if they are aberrant, they are masked above or below the node where they are aberrant
+    sites = list(mutation_counts.items())
+    if not sites:
+        return {}, {}, []
+    #a few chunks per worker, so workers that drew cheap sites pick up more
+    chunksize = max(1, len(sites) // (4 * args.nthreads))
+    records = site_records(run_site_task, sites, order, table, total_mutations, args.min_total, args.nthreads, chunksize)
+    return merge_site_records(records, order, args.mask_chi)
 
 # ------------------ Masking logic ------------------
 
-def mask_mutations(root, mask_below_dict, mask_above_dict):
-    """Mask both below-node and above-node mutations."""
-
-    # Helper to mask all descendants
-    def mask_descendants(node, positions_to_mask):
-        positions_to_mask = set(positions_to_mask)
-        remaining_mutations = [m for m in node.mutations if get_position_from_mutation(m) not in positions_to_mask]
-        node.update_mutations(remaining_mutations, update_branch_length=True)
-        for child in node.children:
-            mask_descendants(child, positions_to_mask)
-
-    # Helper to mask everything except subtree of a node
-    def mask_above(node, target_nodes):
-        for target_id, positions in target_nodes.items():
-            positions_set = set(positions)
-            if not is_descendant(node, target_id) and node.id != target_id:
-                remaining_mutations = [m for m in node.mutations if get_position_from_mutation(m) not in positions_set]
-                node.update_mutations(remaining_mutations, update_branch_length=True)
-        for child in node.children:  # keep your current traversal style
-            mask_above(child, target_nodes)
-
-
-    def is_descendant(node, ancestor_id):
-        current = node
-        while current.parent:
-            if current.parent.id == ancestor_id:
-                return True
-            current = current.parent
-        return False
-
-    # Apply below-node masking
+def mask_mutations(root, mask_below_dict, mask_above_dict, order=None):
+    """Mask both below-node and above-node mutations, returns (node id, position) of every mutation removed."""
+    #one preorder pass over order (TreeOrder of root, made here if not given). a below target masks its
+    #positions in its subtree, the preorder range i:end[i], and an above target everywhere outside it, so
+    #the positions masked at a node only change where a target's range opens or closes. masked counts how
+    #many targets mask each position at the current node, it's updated there and nowhere else
+    if order is None:
+        order = TreeOrder(root)
+    #(positions, +1 for below targets or -1 for above targets) opened at / closed before each preorder index
+    opening = defaultdict(list)
+    closing = defaultdict(list)
+    masked = defaultdict(int)
+    #targets masking the current node, every node they mask has its mutations (and branch length) updated
+    covering = 0
     for node_id, positions in mask_below_dict.items():
-        node = find_node(root, node_id)
-        if node:
-            mask_descendants(node, positions)
-
-    # Apply above-node masking
-    mask_above(root, mask_above_dict)
+        #ids not in the tree mask nothing below
+        if node_id in order.index_of:
+            i = order.index_of[node_id]
+            opening[i].append((set(positions), 1))
+            closing[int(order.end[i])].append((set(positions), 1))
+    for node_id, positions in mask_above_dict.items():
+        #masked everywhere to begin with, and everywhere if the id isn't in the tree
+        covering += 1
+        for position in set(positions):
+            masked[position] += 1
+        if node_id in order.index_of:
+            i = order.index_of[node_id]
+            opening[i].append((set(positions), -1))
+            closing[int(order.end[i])].append((set(positions), -1))
+    positions_to_mask = {position for position, count in masked.items() if count > 0}
+
+    def shift(positions, step):
+        nonlocal covering
+        covering += step
+        for position in positions:
+            masked[position] += step
+            if masked[position] > 0:
+                positions_to_mask.add(position)
+            else:
+                positions_to_mask.discard(position)
+
+    removed = []
+    for i, node in enumerate(order.nodes):
+        for positions, step in closing.pop(i, []):
+            shift(positions, -step)
+        for positions, step in opening.pop(i, []):
+            shift(positions, step)
+        if covering > 0:
+            remaining_mutations = []
+            for m in node.mutations:
+                position = get_position_from_mutation(m)
+                if position in positions_to_mask:
+                    removed.append((node.id, position))
+                else:
+                    remaining_mutations.append(m)
+            node.update_mutations(remaining_mutations, update_branch_length=True)
+    return removed
+
+def remove_masked(table, site_counts, removed):
+    '''
+    Take the mutations mask_mutations removed ((node id, position) pairs) off table (decoded from the
+    searched nodes) and site_counts (position -> count, as get_mutation_counts gives), instead of
+    decoding and counting the whole tree again. Returns the new table, site_counts is updated in place.
+    '''
+    if not removed:
+        return table
+    #nodes collapsed out of the searched tree carry no mutations, so every removal is on a node in the table
+    nodes = np.array([table.index_of[node_id] for node_id, _ in removed], dtype=np.int64)
+    positions = np.array([position for _, position in removed], dtype=np.int64)
+    #one key per (node, position), masking takes every mutation at a masked position off a node
+    stride = int(max(table.pos.max(), positions.max())) + 1
+    rows = np.isin(table.node * stride + table.pos, nodes * stride + positions)
+    for position, count in zip(*np.unique(positions, return_counts=True)):
+        site_counts[int(position)] -= int(count)
+        if site_counts[int(position)] == 0:
+            del site_counts[int(position)]
+    return table.without(rows)
 
 def find_node(node, target_id):
-    if node.id == target_id:
-        return node
-    for child in node.children:
-        res = find_node(child, target_id)
-        if res:
-            return res
+    for current in preorder(node):
+        if current.id == target_id:
+            return current
     return None
 
+def mask_plan_path(output_tree):
+    #the plan goes next to the tree, x.pb.gz -> x.mask_plan.tsv
+    base = output_tree
+    for extension in (".gz", ".pb"):
+        if base.endswith(extension):
+            base = base[:-len(extension)]
+    return base + ".mask_plan.tsv"
+
+def write_mask_plan(plan, filename):
+    with open(filename, "w", newline="") as file:
+        writer = csv.writer(file, delimiter='\t')
+        writer.writerow(PLAN_COLUMNS)
+        for row in plan:
+            writer.writerow([row[column] for column in PLAN_COLUMNS])
+
+def read_mask_plan(filename):
+    with open(filename, newline="") as file:
+        reader = csv.DictReader(file, delimiter='\t')
+        missing = set(PLAN_COLUMNS) - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"{filename} is not a mask plan, missing columns {', '.join(sorted(missing))}")
+        plan = []
+        for row in reader:
+            if row["direction"] not in ("below", "above"):
+                raise ValueError(f"Unknown mask direction {row['direction']} for site {row['site']} in {filename}")
+            plan.append({"site": int(row["site"]), "node_id": row["node_id"], "direction": row["direction"], "chi": float(row["chi"]),
+                         "iteration": int(row["iteration"]), "mutations_removed": int(row["mutations_removed"])})
+    return plan
+
+def apply_mask_plan(root, plan):
+    '''
+    Apply every mask of plan in one mask_mutations pass. Masking only takes mutations off nodes, so this
+    leaves the same tree as masking iteration by iteration did. Returns (node id, position) of every
+    mutation removed.
+    '''
+    mask_below_dict, mask_above_dict = {}, {}
+    for row in plan:
+        masks = mask_below_dict if row["direction"] == "below" else mask_above_dict
+        masks.setdefault(row["node_id"], []).append(row["site"])
+    order = TreeOrder(root)
+    #an above mask on a node that isn't there would mask the site on the whole tree
+    missing = [node_id for node_id in list(mask_below_dict) + list(mask_above_dict) if node_id not in order.index_of]
+    if missing:
+        raise ValueError(f"Mask plan has nodes that aren't in the tree: {', '.join(missing[:10])}")
+    return mask_mutations(root, mask_below_dict, mask_above_dict, order)
+
 def calculate_minimum_mutation_count(mutation_counts):
     '''
     Estimate a reasonable minimum mutation count, where minimum is always 10 but may be high based on mutation count distribution.
@@ -191,9 +387,34 @@ def calculate_max_chi(n, s):
 def main():
     args = parse_args()
     tree = bte.MATree(args.input_tree)
+    if args.apply_plan is not None:
+        plan = read_mask_plan(args.apply_plan)
+        removed = Counter(position for _, position in apply_mask_plan(tree.root, plan))
+        expected = Counter()
+        for row in plan:
+            expected[row["site"]] += row["mutations_removed"]
+        print(f"Applied {len(plan)} masks from {args.apply_plan}, {sum(removed.values())} mutations removed", file=sys.stderr)
+        #a plan applied to the tree it was made from removes what it says, a changed plan or tree may not
+        for site in sorted(set(removed) | set(expected)):
+            if removed[site] != expected[site]:
+                print(f"Site {site}: {removed[site]} mutations removed, the plan says {expected[site]}", file=sys.stderr)
+        print(f"Saving tree to: {args.output_tree}", file=sys.stderr)
+        tree.save_pb(args.output_tree)
+        return
     nodes = [n for n in tree.breadth_first_expansion()]
-    #get counts of mutations at each position
-    mutation_counts = get_mutation_counts(tree.root)
+    #site splits are looked for on the collapsed copy, its nodes read the masked mutations straight from tree
+    search_tree = CollapsedTree(tree, args.collapse) if args.collapse != "none" else tree
+    if args.collapse != "none":
+        print(search_tree.summary(), file=sys.stderr)
+    #walking order worked out once (masking only changes mutations), and every mutation decoded once
+    #in that order, remade only after masking changes the tree
+    order = TreeOrder(search_tree.root)
+    table = decode_mutations(order.nodes)
+    #masks go on the whole tree, which is the tree searched unless it's collapsed
+    mask_order = TreeOrder(tree.root) if args.collapse != "none" else order
+    #get counts of mutations at each position, kept up to date as mutations are masked
+    site_counts = get_mutation_counts(search_tree.root, table)
+    mutation_counts = dict(site_counts)
     print("Counting mutations", file=sys.stderr)
     total_mutations = sum(mutation_counts.values())
     #only keep positions with at least min_count mutations
@@ -209,6 +430,8 @@ def main():
 
     mutation_counts = {k: v for k, v in mutation_counts.items() if v >= min_count}
     
+    #every mask applied, written out as the mask plan
+    plan = []
     iteration = 1
     #go throught positions of interest, find splits, mask mutations above/below nodes
     while len(mutation_counts) > 0:
@@ -218,32 +441,11 @@ def main():
         # of positions checked will be much lower, so it should still be efficient
         print(f"Finding splits. Iteration {iteration}", file=sys.stderr)
 
-        manager = Manager()
-        mask_below_dict = manager.dict()
-        mask_above_dict = manager.dict()
-        chi_list = manager.list()
-
-        processes = []
-        for pos, count in mutation_counts.items():
-            #this is all of the mutations that occur more than min_count times, 
-            #these ones are checked for unlikely distributions of mutations, and 
-            # if they are aberrant, they are masked above or below the node where they are aberrant
-            #print(f"\tPosition: {pos}\tOccurrences: {count}", file=sys.stderr)
-            
-            #this will look at all positions across all nodes in parallel
-            p = run_in_process(tree, pos, count, total_mutations, args, mask_below_dict, mask_above_dict, chi_list)
-            processes.append(p)
-
-            #don't overload with too many processes
-            if len(processes) >= args.nthreads:
-                for proc in processes:
-                    proc.join()
-                processes = []
-
-        #wait for remaining processes
-        for proc in processes:
-            proc.join()
-        
+        if args.engine == "scan":
+            mask_below_dict, mask_above_dict, chi_list = scan_masks(mutation_counts, total_mutations, args, order, table)
+        else:
+            mask_below_dict, mask_above_dict, chi_list = per_site_masks(mutation_counts, total_mutations, args, order, table)
+
         #chi list is a list of all mutations that were checked, dont need to print all 
         #print(f"Mutations checked:", file=sys.stderr)
         #for pos, chi, node_id, direction in sorted(chi_list, key=lambda x: -x[1]):
@@ -257,14 +459,20 @@ def main():
                 if chi > args.mask_chi:
                     print(f"{pos}\t{chi}\t{mutation_counts.get(pos, 0)}\t{node_id}\t{direction}", file=sys.stderr)
 
-            mask_mutations(tree.root, mask_below_dict, mask_above_dict)
+            removed = mask_mutations(tree.root, mask_below_dict, mask_above_dict, mask_order)
+            #a site is masked at one node per iteration, so its removed mutations are all from that mask
+            removed_at = Counter(position for _, position in removed)
+            for pos, chi, node_id, direction in chi_list:
+                if chi > args.mask_chi:
+                    plan.append({"site": pos, "node_id": node_id, "direction": direction, "chi": float(chi),
+                                 "iteration": iteration, "mutations_removed": removed_at[pos]})
 
-            # Recount mutations after masking
-            mutation_counts = get_mutation_counts(tree.root)
+            # Recount mutations after masking, only the ones just removed are taken off
+            table = remove_masked(table, site_counts, removed)
 
             # Keep only positions that were masked for rechecking
             masked_positions = set(pos for positions in list(mask_below_dict.values()) + list(mask_above_dict.values()) for pos in positions)
-            mutation_counts = {k: v for k, v in mutation_counts.items() if k in masked_positions}
+            mutation_counts = {k: site_counts[k] for k in sorted(masked_positions) if k in site_counts}
 
             #i dont think this math is correct
             #print(f"Sites to recheck: {len(mutation_counts)}", file=sys.stderr)
@@ -273,6 +481,12 @@ def main():
 
         iteration += 1
 
+    plan_file = args.mask_plan if args.mask_plan is not None else mask_plan_path(args.output_tree)
+    write_mask_plan(plan, plan_file)
+    print(f"Mask plan with {len(plan)} masks written to: {plan_file}", file=sys.stderr)
+    if args.dry_run:
+        print("Dry run, masked tree not saved", file=sys.stderr)
+        return
     print(f"Saving tree to: {args.output_tree}", file=sys.stderr)
     tree.save_pb(args.output_tree)
 
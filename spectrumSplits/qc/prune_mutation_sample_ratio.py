@@ -1,7 +1,12 @@
-import bte
+import os
 import sys
 import argparse
 import numpy as np
+#shared helpers live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from tree_cache import load_tree
+from mutation_table import decode_mutations
+from traversal import preorder, postorder
 
 # Command-line argument parsing
 def parse_args():
@@ -14,34 +19,38 @@ def parse_args():
     return parser.parse_args()
 
 # Compute the mutation-to-descendant ratio for each node and store it
-def compute_descendants_mutations_ratio(node, mutation_ratio):
-    if not node.children:  # Base case: If node is a tip (no children)
-        mutation_ratio[node.id] = len(node.mutations) / 1  # 1 because it's a tip itself
-        return 1, len(node.mutations), [node.id]  # Return the tip count and mutations
-
-    total_tips = 0
-    total_mutations = len(node.mutations)
-    descendant_tips = []
+# branch_lengths (node id -> number of mutations, from the decoded mutation table) saves going through node.mutations
+def compute_descendants_mutations_ratio(node, mutation_ratio, branch_lengths=None):
+    # children before parents (explicit stack, so deep trees don't hit the recursion limit)
+    tips_below = {}
+    mutations_below = {}
+    for current in postorder(node):
+        node_mutations = branch_lengths[current.id] if branch_lengths is not None else len(current.mutations)
+        if not current.children:  # If node is a tip (no children)
+            mutation_ratio[current.id] = node_mutations / 1  # 1 because it's a tip itself
+            tips_below[current.id] = 1
+            mutations_below[current.id] = node_mutations
+            continue
 
-    for child in node.children:  # Recursive case
-        child_tips, child_mutations, child_descendant_tips = compute_descendants_mutations_ratio(child, mutation_ratio)
-        total_tips += child_tips
-        total_mutations += child_mutations
-        descendant_tips.extend(child_descendant_tips)
+        total_tips = sum(tips_below.pop(child.id) for child in current.children)
+        total_mutations = node_mutations + sum(mutations_below.pop(child.id) for child in current.children)
 
-    ratio = total_mutations / total_tips if total_tips > 0 else float('inf')
-    mutation_ratio[node.id] = ratio
+        ratio = total_mutations / total_tips if total_tips > 0 else float('inf')
+        mutation_ratio[current.id] = ratio
+        tips_below[current.id] = total_tips
+        mutations_below[current.id] = total_mutations
 
-    return total_tips, total_mutations, descendant_tips
+    return tips_below[node.id], mutations_below[node.id], get_descendant_tips(node)
 
 # Traverse the tree and detect changepoints based on mutation/descendant ratio changes
 def detect_changepoints(node, mutation_ratio, threshold, changepoints, to_prune):
-    for child in node.children:
-        if mutation_ratio[child.id] >= threshold:
-            changepoints.append((node.id, child.id, mutation_ratio[child.id], child))
-            to_prune.add(child)
-            continue
-        detect_changepoints(child, mutation_ratio, threshold, changepoints, to_prune)
+    # nodes over the threshold are recorded in the order a recursive walk finds them, and not gone into
+    def below_changepoint(child):
+        return child.parent.id != node.id and mutation_ratio[child.parent.id] >= threshold
+    for current in preorder(node, skip=below_changepoint):
+        if current.id != node.id and mutation_ratio[current.id] >= threshold:
+            changepoints.append((current.parent.id, current.id, mutation_ratio[current.id], current))
+            to_prune.add(current)
 
 # Determine the threshold based on the overall distribution of ratios
 def compute_threshold(mutation_ratios, k=3):
@@ -74,13 +83,7 @@ def prune_tree(tree, to_prune):
 
 # Helper function to get all descendant tips of a node
 def get_descendant_tips(node):
-    if not node.children:  # Base case: If node is a tip
-        return [node.id]
-
-    tips = []
-    for child in node.children:
-        tips.extend(get_descendant_tips(child))
-    return tips
+    return [current.id for current in preorder(node) if not current.children]
 
 #Original version of script prunes internal nodes from tree, however this version outputs a list of samples to prune, which can be used to prune the tree in a separate step.
 #This version is compatible with analyze.smk which will use matUtils to prune the tree based on the list of samples to prune. 
@@ -88,10 +91,12 @@ def get_descendant_tips(node):
 
 def main():
     args = parse_args()
-    tree = bte.MATree(args.input_tree)
+    tree = load_tree(args.input_tree)
 
+    table = decode_mutations(tree.depth_first_expansion())
+    branch_lengths = dict(zip(table.ids, table.branch_lengths().tolist()))
     mutation_ratio = {}
-    compute_descendants_mutations_ratio(tree.root, mutation_ratio)
+    compute_descendants_mutations_ratio(tree.root, mutation_ratio, branch_lengths)
 
     #If threshold is set to 0 (default), script will compute a threshold 
     # based on the distribution of mutation:descendant ratios across the tree.
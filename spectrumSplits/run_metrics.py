@@ -0,0 +1,97 @@
+import sys
+import json
+import time
+import logging
+import resource
+from checkpoint import atomic_write
+
+### levelled logging and a JSON file of run metrics (timings, work done, memory), so SLURM requests
+### can be sized and regressions spotted from numbers rather than by grepping the logs
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+def setup_logging(level="INFO"):
+    '''
+    Log to stderr with timestamps. INFO gives one line per search iteration and per finished
+    replicate, DEBUG adds the per split root and per new split messages.
+    '''
+    logging.basicConfig(stream=sys.stderr, level=getattr(logging, level), format="%(asctime)s %(levelname)s %(message)s")
+
+def peak_rss_mb():
+    #ru_maxrss is in KB on linux. children is the largest finished child (bootstrap workers), not their sum
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+def summarize(values):
+    if not values:
+        return None
+    return {"count": len(values), "total": sum(values), "mean": sum(values) / len(values), "min": min(values), "max": max(values)}
+
+class RunMetrics:
+    '''
+    Metrics of one run, rewritten to path (atomically) after every search iteration, finished
+    replicate and stage, so a job killed at its time limit still leaves its numbers behind:
+    settings, wall time of each stage, whether the split search converged, each split search
+    iteration (time, candidate nodes scored, chi tests per second, splits accepted/finalized),
+    each bootstrap replicate's time, and peak RSS.
+    Without a path nothing is written.
+    '''
+    def __init__(self, path=None, settings=None):
+        self.path = path
+        self.start = time.perf_counter()
+        self.settings = settings if settings is not None else {}
+        self.stages = {}
+        self.iterations = []
+        self.replicates = {"splits": {}, "spectra": {}}
+        #false when the split search was stopped by --time_budget
+        self.converged = None
+
+    def stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+        self.write()
+
+    def iteration(self, seconds, candidates, accepted, finalized, new_splits):
+        self.iterations.append({"iteration": len(self.iterations) + 1, "seconds": seconds, "candidates_scored": candidates,
+                                "chi_tests_per_second": candidates / seconds if seconds > 0 else None,
+                                "new_splits": new_splits, "accepted_splits": accepted, "finalized_splits": finalized})
+        self.write()
+
+    def replicates_done(self, kind, seconds):
+        #seconds: replicate -> its time, for the replicates that just finished
+        self.replicates[kind].update((str(replicate), value) for replicate, value in seconds.items())
+        self.write()
+
+    def as_dict(self):
+        scored = sum(iteration["candidates_scored"] for iteration in self.iterations)
+        search_seconds = sum(iteration["seconds"] for iteration in self.iterations)
+        return {"settings": self.settings,
+                "elapsed_seconds": time.perf_counter() - self.start,
+                "peak_rss_mb": peak_rss_mb(),
+                "stages": self.stages,
+                "converged": self.converged,
+                "search": {"iterations": len(self.iterations), "seconds": search_seconds, "candidates_scored": scored,
+                           "chi_tests_per_second": scored / search_seconds if search_seconds > 0 else None,
+                           "accepted_splits": self.iterations[-1]["accepted_splits"] if self.iterations else None,
+                           "finalized_splits": self.iterations[-1]["finalized_splits"] if self.iterations else None},
+                "iterations": self.iterations,
+                "replicate_summary": {kind: summarize(list(seconds.values())) for kind, seconds in self.replicates.items()},
+                "replicates": self.replicates}
+
+    def write(self):
+        if self.path is not None:
+            atomic_write(self.path, json.dumps(self.as_dict(), indent=1))
+
+class timed_stage:
+    #with timed_stage(metrics, "name"): ... adds the block's wall time to the stage (metrics may be None)
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.metrics is not None:
+            self.metrics.stage(self.name, time.perf_counter() - self.start)
+        return False
@@ -1,15 +1,29 @@
-import bte
 import sys
 import copy
 import csv 
 import random
 import argparse
-import random
 import os
-from multiprocessing import Process
+import time
+import logging
+from multiprocessing import get_context
 from collections import defaultdict
-from scipy.stats import chi2_contingency
+import numpy as np
 from scipy.stats import chi2
+from tree_index import TreeIndex, MUTATION_TYPES, spectrum_row_to_dict
+from chi_scoring import score_splits
+from bootstrap_engine import draw_weights, split_spectra_matrix, replicate_batches, replicate_rng, parse_replicate_range
+from checkpoint import SearchCheckpoint, TimeBudget, start_checkpoint_dir, completed_replicates, record_replicate, link_replicates
+from bootstrap_store import BootstrapStore, store_filename
+from split_support import SplitSupport
+from tree_cache import load_tree
+from mutation_table import decode_mutations
+from traversal import preorder, postorder, TreeOrder
+from run_metrics import RunMetrics, setup_logging, timed_stage, LOG_LEVELS
+from split_hierarchy import SplitHierarchy
+from collapse_tree import CollapsedTree, CollapsedNode, COLLAPSE_MODES
+
+log = logging.getLogger("spectrumSplits")
 
 # Command-line argument parsing
 def parse_args():
@@ -21,69 +35,75 @@ def parse_args():
     parser.add_argument("--ntips", type=int, default=5, help="Number of tips to retrieve for each split")
     parser.add_argument("--bootstrap_splits", type=int, default=0, help="Number of bootstrap replicates to attempt in defining splits")
     parser.add_argument("--bootstrap_spectra", type=int, default=0, help="Number of bootstrap replicates to attempt in defining spectra")
-    parser.add_argument("--nthreads", type=int, default=1, help="Number of threads for concurrent bootstrapping")
+    parser.add_argument("--nthreads", type=int, default=1, help="Number of processes for the main split search (split roots of an iteration are scored concurrently) and for concurrent bootstrapping")
     parser.add_argument("--max_branch_length", type=int, default=100000, help="Maximum branch length to include in spectrum calculations")
     parser.add_argument("--bootstrap_dir", type=str, default=".", help="Directory to write bootstrap output files")
     parser.add_argument("--calculate_min_chi", action="store_true", help="Option to calculate minimum chi-square value based on tree size")
-    #parser.add_argument("--aplha", type=int, default=42, help="Random seed for reproducibility
+    parser.add_argument("--bootstrap_batch_size", type=int, default=100, help="With an index engine, number of --bootstrap_spectra replicates computed together in one sparse matrix product")
+    parser.add_argument("--checkpoint_dir", type=str, default=None, help="Directory for checkpoints. The main split search is saved after every iteration and bootstrap replicates are written here with a completion manifest, so a restarted run resumes instead of starting over. Keep it outside directories snakemake clears on failure")
+    parser.add_argument("--bootstrap_output", type=str, default="tsv", choices=["tsv", "npz"], help="How bootstrap replicates are saved: a TSV per replicate, or all replicates of a kind in one compressed columnar bootstrap_{splits,spectra}.npz in --bootstrap_dir (read with bootstrap_store.load_bootstrap_store)")
+    parser.add_argument("--bootstrap_report", type=str, default=None, help="Split support report, updated as --bootstrap_splits replicates finish: how often each split reappears, the mean and SD of its spectrum, and for each main split the mean node distance and jaccard similarity of the spectra to the nearest split of each replicate (split_support.py makes the same report from the stored replicates)")
+    parser.add_argument("--engine", type=str, default="recursive", choices=["recursive", "index", "incremental"], help="Split search engine. 'index' flattens the tree once into arrays and computes all subtree spectra in one pass (much faster and smaller on big trees). 'incremental' is the index engine keeping spectra between iterations and only rescoring split roots that changed")
+    parser.add_argument("--seed", type=int, default=None, help="Base random seed. Every bootstrap replicate draws from its own stream derived from this seed and its replicate number, so a replicate is identical wherever it runs")
+    parser.add_argument("--replicate_range", type=str, default=None, help="Only run bootstrap replicates START:END (1 based, inclusive), e.g. one shard of a SLURM array. Combine shard directories with merge_bootstrap_shards.py")
+    parser.add_argument("--branch_and_bound", action="store_true", help="Only compute chi for candidate splits whose upper bound (from their own and the rest of the split root's mutation totals) can still beat the best so far and min_chi, largest bounds first. Same splits, fewer chi tests, but the bound pass costs about what it saves: on synthetic trees of 1000 to 16000 tips (benchmarks/bench_stages.py) searches are no faster, up to 20%% slower, so it is off by default")
+    parser.add_argument("--sweep", type=str, nargs="+", default=[], help="More split searches on the same tree, one report each, all in this process on one tree index and its cached spectra. Each is output=PATH[,min_chi=X|calculate][,min_mutations=N][,max_branch_length=M], anything left out is taken from the main run (min_chi=calculate is --calculate_min_chi)")
+    parser.add_argument("--split_hierarchy", type=str, default=None, help="JSON record of the main split search (each accepted split with its parent split root, chi, mutations on either side and iteration, and the subtree spectra), from which split_hierarchy.py writes the report for a stricter min_chi or min_mutations without the tree")
+    parser.add_argument("--time_budget", type=float, default=None, help="Wall clock seconds this run may take (set it a few minutes under the job's time limit). The split search stops before an iteration that might not finish in time, writes the splits accepted so far to OUTPUT.not_converged.tsv, saves its state (in --checkpoint_dir, or OUTPUT.search_state.json, removed once the search converges) for the next run with the same settings to carry on from, and exits with status 3 without bootstrapping")
+    parser.add_argument("--collapse", type=str, default="none", choices=COLLAPSE_MODES, help="Search a copy of the tree without internal nodes that carry no mutations (collapse_tree.py). 'unary' drops those with a single child and gives the same splits and spectra with fewer nodes to walk, 'zero' also folds those with several children into their parent so splits only fall on branches with mutations. Split ids are the original node ids")
+    parser.add_argument("--log_level", type=str, default="INFO", choices=LOG_LEVELS, help="Logging level. INFO logs each search iteration and finished replicate, DEBUG also every split root scored and split found")
+    parser.add_argument("--metrics_file", type=str, default=None, help="JSON file of run metrics, rewritten as the run goes: time of each stage, per iteration time, candidates scored and chi tests per second, splits accepted and finalized, per replicate bootstrap times, and peak RSS")
     return parser.parse_args()
 
 ### mutation positions 
 def get_positions( node ) :
-    positions = set() 
-    for mutation in node.mutations:
-        positions.add( int(mutation[1:-1]) )
-    for child in node.children :
-        positions.update( get_positions( child ) ) 
-    return positions 
+    #every position mutated in the subtree, from the decoded mutation table
+    return set( decode_mutations( preorder( node ) ).pos.tolist() )
 
 ### create bootstrap weights by alignment position
-def create_bootstrap( positions, n_samples=None ) :
-    bootstrap_weights = defaultdict(int)  # Initialize a defaultdict to store counts
+def create_bootstrap( positions, n_samples=None, rng=None ) :
+    positions_list = sorted(positions)  # sorted so a seeded rng gives the same draw on every machine
     if n_samples is None:
-        n_samples = len(positions)  # Default to the size of the original set
-    positions_list = list(positions)  # Convert set to list for indexing
-    for _ in range(n_samples):
-        selected_position = random.choice(positions_list)
-        bootstrap_weights[selected_position] += 1
-    return dict(bootstrap_weights)
+        n_samples = len(positions_list)  # Default to the size of the original set
+    # same draw as draw_weights on the index engines, so both engines agree for a given rng
+    counts = draw_weights(len(positions_list), 1, rng, n_samples)[:, 0]
+    return {position: int(count) for position, count in zip(positions_list, counts) if count}
 
 def compute_mutation_spectrum(node, stop_nodes, spectrum_dict, weights=None, max_branch_length=100000):
     # Check if the spectrum for this node has already been computed
     if node in spectrum_dict:
         return spectrum_dict[node]
-    
-    #what is local spectrum?
-    
-    local_spectrum = defaultdict(int)
-    #iterate throungh nodes of children
-    for child in node.children:
-        #what is a stop node?
-        if any(child.id == stop_node.id for stop_node in stop_nodes):
-            continue
-        #recursive call to compute child spectrum
-        child_spectrum = compute_mutation_spectrum(child, stop_nodes, spectrum_dict, weights, max_branch_length)
+
+    #subtrees rooted at a stop node (another split) are left out
+    stop_ids = set(stop_node.id for stop_node in stop_nodes)
+    #children before parents (explicit stack, deep trees don't hit the recursion limit), so spectrum_dict
+    #fills in the same order as the recursive version did. already computed subtrees aren't walked again
+    for current in postorder(node, skip=lambda child: child.id in stop_ids or child in spectrum_dict):
+        local_spectrum = defaultdict(int)
         #local spectrum is calculated as spectra of subtrees where current node is root
-        for mutation_type, count in child_spectrum.items():
-            local_spectrum[mutation_type] += count
-
-    #why do we have max branch length ?
-    #after getting lcal spectrum of children, we add current node to local spectrum
-    if len(node.mutations) <= max_branch_length:
-
-        for mutation in node.mutations:
-            char1 = mutation[0]
-            char2 = mutation[-1]
-            mutation_type = char1 + char2
-            pos = int(mutation[1:-1])
-            
-            # Assign weight 1 if weights is None; otherwise, check if pos is in weights dict and it gets that weigth or 0 otherwise
-            weight = weights.get(pos, 0) if weights else 1
-            local_spectrum[mutation_type] += weight
-    
-    #populate spectrum dict
-    spectrum_dict[node] = local_spectrum
-    return local_spectrum
+        for child in current.children:
+            if child.id in stop_ids:
+                continue
+            for mutation_type, count in spectrum_dict[child].items():
+                local_spectrum[mutation_type] += count
+
+        #why do we have max branch length ?
+        #after getting lcal spectrum of children, we add current node to local spectrum
+        if len(current.mutations) <= max_branch_length:
+
+            for mutation in current.mutations:
+                char1 = mutation[0]
+                char2 = mutation[-1]
+                mutation_type = char1 + char2
+                pos = int(mutation[1:-1])
+
+                # Assign weight 1 if weights is None; otherwise, check if pos is in weights dict and it gets that weigth or 0 otherwise
+                weight = weights.get(pos, 0) if weights else 1
+                local_spectrum[mutation_type] += weight
+
+        #populate spectrum dict
+        spectrum_dict[current] = local_spectrum
+    return spectrum_dict[node]
 
 def compute_spectrum_difference(spectrum1, spectrum2):
     difference_spectrum = defaultdict(int)
@@ -109,20 +129,25 @@ def normalize_spectrum(d):
 def get_spectra(finalized_splits, max_branch_length, weights=None):
     final_spectra = {} 
     for split_root in finalized_splits:
-        print(f"Computing spectrum for subtree beginning at {split_root.id}", file=sys.stderr)
+        log.debug(f"Computing spectrum for subtree beginning at {split_root.id}")
         spectrum_dict = {}
         final_spectra[split_root] = compute_mutation_spectrum(split_root, finalized_splits, spectrum_dict, weights, max_branch_length)
     return final_spectra
 
-def write_spectra_to_tsv(spectra_dict, filename, ntips):
+def write_spectra_to_tsv(spectra_dict, filename, ntips, tips_by_node=None):
     all_keys = {"AC", "AG", "AT", "CA", "CG", "CT", "GA", "GC", "GT", "TA", "TC", "TG"}
     sorted_keys = sorted(all_keys)
-    with open(filename, "w", newline="") as file:
+    #written under a temporary name and renamed, so a killed run never leaves a partial report
+    tmp_filename = filename + ".part"
+    with open(tmp_filename, "w", newline="") as file:
         writer = csv.writer(file, delimiter='\t')
         header = ["Node_ID"] + ["Total_Mutations"] + ["Number_Tips"] + ["Mutations:Tips"]+ sorted_keys + ["Exemplar tips"]
         writer.writerow(header)
-        for node, spectrum in spectra_dict.items():
-            tips = get_tips( spectra_dict.keys(), node )
+        #rows go root first (by depth, then id) rather than in set order, so seeded runs write identical
+        #files and the whole-tree split is always on line 2 where check_reports.sh looks for it
+        for node, spectrum in sorted(spectra_dict.items(), key=lambda item: (node_depth(item[0]), item[0].id)):
+            #tips can be passed in when the same splits are written many times (bootstrap spectra)
+            tips = tips_by_node[node] if tips_by_node is not None else get_tips( spectra_dict.keys(), node )
             if ntips > 0 :
                 normalized_spectrum = normalize_spectrum(spectrum)
                 #divide by zero error
@@ -134,20 +159,23 @@ def write_spectra_to_tsv(spectra_dict, filename, ntips):
                 #divide by zero error (same guard as the ntips > 0 branch above)
                 row = [node.id] + [sum(spectrum.values())] + [len(tips)] + [float(sum(spectrum.values()))/float(len(tips)) if len(tips) > 0 else "NA"] + [normalized_spectrum.get(key, 0) for key in sorted_keys]
                 writer.writerow(row)
-    print(f"Spectra written to {filename}", file=sys.stderr)
+    os.replace(tmp_filename, filename)
+    log.info(f"Spectra written to {filename}")
+
+def node_depth(node):
+    #depth in the whole tree, which a collapsed tree's nodes keep
+    if isinstance(node, CollapsedNode):
+        return node.depth
+    depth = 0
+    while node.parent:
+        depth += 1
+        node = node.parent
+    return depth
 
 def get_tips(splits, node):
-    tips = []
-    def traverse(current_node):
-        if current_node.is_leaf():
-            tips.append(current_node.id)
-        else:
-            for child in current_node.children:
-                if any(child.id == split.id for split in splits):
-                    continue
-                traverse(child)
-    traverse(node)
-    return tips
+    #tips in node's subtree, not going into other splits, in the order a recursive walk finds them
+    split_ids = set(split.id for split in splits)
+    return [current_node.id for current_node in preorder(node, skip=lambda child: child.id in split_ids) if current_node.is_leaf()]
 
 def write_tips(tips, ntips):
     if len(tips) == 0:
@@ -165,203 +193,595 @@ def calculate_min_chi_value(number_n, traversal):
     return min_chi
 
 
-def find_splits(node, min_chi, min_mutations, max_branch_length, weights=None, calculate_min_chi=False, tree_size=None):
+def get_nodes_by_id(root):
+    return {node.id: node for node in preorder(root)}
+
+def hierarchy_state(hierarchy):
+    #extra checkpoint fields when the search is being recorded
+    return {"hierarchy": hierarchy.state()} if hierarchy is not None else {}
+
+def end_iteration(metrics, progress, started, scored, new_splits, accepted, finalized, budget=None):
+    #accepted counts include the whole tree root, as in the checkpoints. false if the search has to stop
+    #here to stay within budget (a checkpoint.TimeBudget), with splits still to finalize
+    seconds = time.perf_counter() - started
+    log.log(progress, f"End of iteration: {new_splits} new splits added, {accepted - 1} total accepted splits, {finalized} finalized ({scored} candidates scored in {seconds:.3f}s)")
+    if metrics is not None:
+        metrics.iteration(seconds, scored, accepted - 1, finalized, new_splits)
+    if budget is None or accepted == finalized or budget.allows(seconds):
+        return True
+    log.warning(f"Stopping the split search with {max(budget.remaining(), 0):.0f}s of the time budget left, {accepted - finalized} accepted splits not finalized")
+    return False
+
+def resume_search(checkpoint, lookup, hierarchy=None):
+    #accepted splits, finalized splits and traversal from a saved search (ids mapped through lookup), or None
+    state = checkpoint.load() if checkpoint is not None else None
+    if state is None:
+        return None
+    if hierarchy is not None:
+        hierarchy.resume(state.get("hierarchy"))
+    return [lookup[i] for i in state["accepted"]], [lookup[i] for i in state["finalized"]], state["traversal"]
+
+### split roots of one iteration scored in parallel. each split root's search stops at the other accepted
+### splits, so they don't depend on each other. the pool is forked at the start of the iteration, so workers
+### see the tree and this iteration's accepted splits (and spectra) without anything being pickled, and the
+### results come back in the order the roots were given, so accepting and finalizing happen as in a serial run
+_search = {}
+
+def run_score_task(i):
+    return _search["score"](_search["split_roots"][i])
+
+def score_split_roots(score, split_roots, nthreads=1):
+    #[score(split_root) for split_root in split_roots], over up to nthreads processes
+    if nthreads <= 1 or len(split_roots) <= 1:
+        return [score(split_root) for split_root in split_roots]
+    _search["score"] = score
+    _search["split_roots"] = split_roots
+    try:
+        with get_context("fork").Pool(min(nthreads, len(split_roots))) as pool:
+            return pool.map(run_score_task, range(len(split_roots)), chunksize=1)
+    finally:
+        _search.clear()
+
+def score_split_root(splitRoot, accepted_splits, weights, max_branch_length, min_mutations, min_chi=None, bounded=False):
+    #best split in the subtree rooted at splitRoot (not going into other accepted splits): (max_chi, id of
+    #the node it is at or None, number of candidates scored, mutations below and above it or None)
+    log.debug(f"Computing spectrum for subtree beginning at {splitRoot.id}")
+    #spectrum dict will hold spectra for all subtrees with root [node] in tree
+    spectrum_dict = {}
+    #get spectrum for tree descending from node 
+    #will also populate spectrum dict for all nodes in tree
+    split_root_spectrum = compute_mutation_spectrum(splitRoot, accepted_splits, spectrum_dict, weights, max_branch_length)
+    log.debug(f"Computing distances between splits in (sub)tree {splitRoot.id}")
+    #spectrum dict should have spectra for all subtrees in tree
+    #node is no longer root of tree, but of subtree
+    #score every node in the subtree rooted at splitRoot as a possible split in one batch,
+    #comparing the spectrum of the subtree rooted at node with the rest of splitRoot's tree
+    candidates = list(spectrum_dict)
+    below = np.array([[spectrum_dict[node].get(mutation, 0) for mutation in MUTATION_TYPES] for node in candidates]).reshape(-1, len(MUTATION_TYPES))
+    below_totals = np.array([sum(spectrum_dict[node].values()) for node in candidates])
+    root_counts = np.array([split_root_spectrum.get(mutation, 0) for mutation in MUTATION_TYPES])
+    #will only consider the split with the largest chi
+    root_total = sum(split_root_spectrum.values())
+    max_chi, best = score_splits(below, below_totals, root_counts, root_total, min_mutations, min_chi, bounded)
+    if best is None:
+        return max_chi, None, len(candidates), None
+    #an id rather than the node, so the result can come back from a worker process
+    return max_chi, candidates[best].id, len(candidates), (below_totals[best], root_total - below_totals[best])
+
+def find_splits(node, min_chi, min_mutations, max_branch_length, weights=None, calculate_min_chi=False, tree_size=None, checkpoint=None, metrics=None, progress=logging.INFO, nthreads=1, bounded=False, hierarchy=None, budget=None):
+    #iteration summaries are logged at progress (bootstrap replicates pass DEBUG), metrics gets the per iteration numbers.
+    #with nthreads > 1 the split roots of an iteration are scored in parallel (score_split_roots), with bounded
+    #candidates that can't beat the best one so far are skipped (chi_scoring.score_splits). hierarchy (a
+    #split_hierarchy.SplitHierarchy) records every split accepted and finalized. a search stopped by budget
+    #(a checkpoint.TimeBudget) returns all the splits accepted so far instead of the finalized ones
     accepted_splits = set({node})
     finalized_splits = set()
     traversal = 1
+    nodes_by_id = get_nodes_by_id(node)
+    resumed = resume_search(checkpoint, nodes_by_id, hierarchy) if checkpoint is not None else None
+    if resumed is not None:
+        accepted_splits, finalized_splits, traversal = set(resumed[0]), set(resumed[1]), resumed[2]
 
     while len(accepted_splits) > len(finalized_splits):
         #may be better to use candidate nodes than total nodes in tree? will check side by side
         if calculate_min_chi:
             min_chi = calculate_min_chi_value(tree_size, traversal)
             traversal += 1
-            print('maybe min chi:', min_chi)
-            
-
+            log.log(progress, f"Minimum chi for iteration {traversal - 1}: {min_chi}")
+        if hierarchy is not None:
+            hierarchy.start_iteration(min_chi)
 
-        print(f"Starting iteration with {len(accepted_splits)-1} accepted splits and {len(finalized_splits)} finalized splits", file=sys.stderr)
+        log.debug(f"Starting iteration with {len(accepted_splits)-1} accepted splits and {len(finalized_splits)} finalized splits")
+        started = time.perf_counter()
+        scored = 0
         new_split = set()
-        #iterate through current accepted splits
+        #current accepted splits, skipping those already finalized
+        split_roots = []
         for splitRoot in accepted_splits:
-            #skip if already finalized
             if any(splitRoot.id == stop_node.id for stop_node in finalized_splits):
-                print(f"Finalized split skipped:  {splitRoot.id}", file=sys.stderr)
+                log.debug(f"Finalized split skipped:  {splitRoot.id}")
                 continue
-            print(f"Computing spectrum for subtree beginning at {splitRoot.id}", file=sys.stderr)
-            #spectrum dict will hold spectra for all subtrees with root [node] in tree
-            spectrum_dict = {}
-            #get spectrum for tree descending from node 
-            #will also populate spectrum dict for all nodes in tree
-            split_root_spectrum = compute_mutation_spectrum(splitRoot, accepted_splits, spectrum_dict, weights, max_branch_length)
-            print(f"Computing distances between splits in (sub)tree {splitRoot.id}", file=sys.stderr)
-            max_chi = 0
-            max_chi_node = None
-            #spectrum dict should have spectra for all subtrees in tree
-            #node is no longer root of tree, but of subtree
-            #iterate through all nodes in tree
-            #this looks for subsequent possible splits within subtree rooted at splitRoot
-            for node in spectrum_dict:
-                #subtree from node needs to have enough mutations to be considered
-                if sum(spectrum_dict[node].values()) < min_mutations:
-                    continue
-                #i beleive that this is the tree outside of the subtree rooted at node, may need to confirm
-                #tree above splitroot ?
-                #i feel like i dont get this. i feel like this should be spectrum of tree excluding subtree rooted at node
-                #it seems like split_root_spectrum is spectrum of subtree rooted at splitRoot
-                #i guess this doesnt matter a ton rn but i dont think this makes sense
-                #####HELP
-                ### this is confusing on 
-                #splitroot sp
-                if sum(split_root_spectrum.values()) - sum(spectrum_dict[node].values()) < min_mutations:
-                    continue
-                
-                #note that meaning of splitroot_spectrum_list is spectrum of subtree rooted at node
-                #meaning of above_spectrum_list is spectrum of tree rooted at splitRoot excluding subtree rooted at node
-                splitroot_spectrum_list = []
-                above_spectrum_list = [] 
-                for mutation in ["AC","AG","AT","CA","CG","CT","GA","GC","GT","TA","TC","TG"] :
-                    if mutation in spectrum_dict[node].keys():
-                        # Append the count from the node's spectrum, why?
-                        splitroot_spectrum_list.append(spectrum_dict[node][mutation])
-                    else:
-                        # Append 0 if the mutation is missing from the spectrum
-                        splitroot_spectrum_list.append(0)
-                    
-                    if mutation in split_root_spectrum.keys():
-                        # Calculate the difference, but handle cases where mutation is missing from node
-                        above_spectrum_list.append(split_root_spectrum[mutation] - spectrum_dict[node].get(mutation, 0))
-                    else:
-                        # Append 0 if the mutation is missing from the split_root_spectrum
-                        above_spectrum_list.append(0)
-
-                #a mutation type with zero counts on BOTH sides carries no information, and
-                #chi2_contingency raises on it (its expected frequency would be zero, so the
-                #chi calculation would divide by zero). leaving those types out gives exactly
-                #the same chi value as treating their 0/0 term as 0, so the min_chi cutoff
-                #still applies unchanged. note the dof returned below is then 10 rather than
-                #11, but it is never read -- calculate_min_chi_value sets its own dof=11.
-                kept_columns = [i for i in range(len(splitroot_spectrum_list))
-                                if splitroot_spectrum_list[i] + above_spectrum_list[i] > 0]
-                if len(kept_columns) < 2:
-                    #fewer than two types observed at all, nothing to compare
-                    continue
-                chi, p, dof, expected = chi2_contingency([
-                    [splitroot_spectrum_list[i] for i in kept_columns],
-                    [above_spectrum_list[i] for i in kept_columns]])
-                print(chi)
-                '''
-                node_spectrum_difference = compute_spectrum_difference(
-                    normalize_spectrum(spectrum_dict[node]),
-                    normalize_spectrum(subtract_spectra(split_root_spectrum, spectrum_dict[node]))
-                )
-                chi = sum(node_spectrum_difference.values()) * min(
-                    sum(spectrum_dict[splitRoot].values()) - sum(spectrum_dict[node].values()),
-                    sum(spectrum_dict[node].values())
-                )
-                '''
-                #check if chi is the largest seen so far
-                #will only consider the split with the largest chi
-                if chi > max_chi:
-                    max_chi = chi
-                    max_chi_node = node
+            split_roots.append(splitRoot)
+        results = score_split_roots(lambda splitRoot: score_split_root(splitRoot, accepted_splits, weights, max_branch_length, min_mutations, min_chi, bounded), split_roots, nthreads)
+        for splitRoot, (max_chi, max_chi_id, ncandidates, sides) in zip(split_roots, results):
+            scored += ncandidates
+            max_chi_node = nodes_by_id[max_chi_id] if max_chi_id is not None else None
             #after iterating through all nodes in tree, check if max chi is above threshold
             #if it is, add to new splits
             if max_chi > min_chi:
                 
                 if max_chi_node and max_chi_node not in accepted_splits:
                     new_split.add(max_chi_node)
-                    print(f"New split found at {max_chi_node.id} with x2 {max_chi}", file=sys.stderr)
+                    log.debug(f"New split found at {max_chi_node.id} with x2 {max_chi}")
+                    if hierarchy is not None:
+                        hierarchy.accepted(splitRoot.id, max_chi_node.id, max_chi, sides)
             else:
                 finalized_splits.add(splitRoot)
-                print(f"Finalized subtree rooted at {splitRoot.id}", file=sys.stderr)
+                log.debug(f"Finalized subtree rooted at {splitRoot.id}")
+                if hierarchy is not None:
+                    hierarchy.finalized(splitRoot.id, max_chi)
         accepted_splits = accepted_splits.union(new_split)
-        print(f"End of iteration: {len(new_split)} new splits added, {len(accepted_splits) -1} total accepted splits", file=sys.stderr)
+        if checkpoint is not None:
+            checkpoint.save([n.id for n in accepted_splits], [n.id for n in finalized_splits], traversal, **hierarchy_state(hierarchy))
+        if not end_iteration(metrics, progress, started, scored, len(new_split), len(accepted_splits), len(finalized_splits), budget):
+            return accepted_splits
     return finalized_splits
 
-def bootstrap_replicate ( tree, replicate, min_chi, min_mutations, ntips, max_branch_length, calculate_min_chi, bootstrap_dir="." ) :
-    print(f"Begining bootstrap no: {replicate}", file=sys.stderr)
+### array based versions of find_splits/get_spectra, reading from a TreeIndex
+def best_split_indexed(spectra, candidates, root, min_mutations, min_chi=None, bounded=False):
+    #same rules as find_splits: min_mutations on both sides, all-zero types dropped
+    ntypes = len(MUTATION_TYPES)
+    max_chi, best = score_splits(spectra[candidates, :ntypes], spectra[candidates].sum(axis=1), spectra[root, :ntypes], spectra[root].sum(), min_mutations, min_chi, bounded)
+    return max_chi, (candidates[best] if best is not None else None)
+
+def score_region(spectra, candidates, split_root, min_mutations, index, min_chi=None, bounded=False):
+    #best_split_indexed for one split root, with the number of candidates scored
+    log.debug(f"Computing distances between splits in (sub)tree {index.ids[split_root]}")
+    max_chi, max_chi_node = best_split_indexed(spectra, candidates, split_root, min_mutations, min_chi, bounded)
+    return max_chi, max_chi_node, len(candidates)
+
+def split_sides(spectra, split_root, node):
+    #mutations below node and in the rest of split_root's region
+    below = spectra[node].sum()
+    return below, spectra[split_root].sum() - below
+
+def start_search_indexed(index, checkpoint, hierarchy=None):
+    #accepted/finalized masks and traversal, either fresh (just the root, last in postorder) or from a checkpoint
+    accepted = np.zeros(index.size, dtype=bool)
+    finalized = np.zeros(index.size, dtype=bool)
+    accepted[index.size - 1] = True
+    traversal = 1
+    resumed = resume_search(checkpoint, index.index_of, hierarchy)
+    if resumed is not None:
+        accepted[resumed[0]] = True
+        finalized[resumed[1]] = True
+        traversal = resumed[2]
+    return accepted, finalized, traversal
+
+def save_search_indexed(index, checkpoint, accepted, finalized, traversal, hierarchy=None):
+    if checkpoint is not None:
+        checkpoint.save([index.ids[i] for i in np.flatnonzero(accepted)], [index.ids[i] for i in np.flatnonzero(finalized)], traversal, **hierarchy_state(hierarchy))
+
+def find_splits_indexed(index, min_chi, min_mutations, weights=None, calculate_min_chi=False, tree_size=None, checkpoint=None, metrics=None, progress=logging.INFO, nthreads=1, bounded=False, hierarchy=None, budget=None):
+    branch = index.branch_matrix(weights)
+    accepted, finalized, traversal = start_search_indexed(index, checkpoint, hierarchy)
+
+    while accepted.sum() > finalized.sum():
+        if calculate_min_chi:
+            min_chi = calculate_min_chi_value(tree_size, traversal)
+            traversal += 1
+            log.log(progress, f"Minimum chi for iteration {traversal - 1}: {min_chi}")
+        if hierarchy is not None:
+            hierarchy.start_iteration(min_chi)
+
+        log.debug(f"Starting iteration with {accepted.sum()-1} accepted splits and {finalized.sum()} finalized splits")
+        started = time.perf_counter()
+        scored = 0
+        #spectra of every node with subtrees under other accepted splits cut off
+        spectra = index.subtree_spectra(branch, accepted)
+        region = index.regions(accepted)
+        new_split = []
+        split_roots = np.flatnonzero(accepted & ~finalized)
+        results = score_split_roots(lambda split_root: score_region(spectra, np.flatnonzero(region == split_root), split_root, min_mutations, index, min_chi, bounded), split_roots, nthreads)
+        for split_root, (max_chi, max_chi_node, ncandidates) in zip(split_roots, results):
+            scored += ncandidates
+            if max_chi > min_chi:
+                if max_chi_node is not None and not accepted[max_chi_node]:
+                    new_split.append(max_chi_node)
+                    log.debug(f"New split found at {index.ids[max_chi_node]} with x2 {max_chi}")
+                    if hierarchy is not None:
+                        hierarchy.accepted(index.ids[split_root], index.ids[max_chi_node], max_chi, split_sides(spectra, split_root, max_chi_node))
+            else:
+                finalized[split_root] = True
+                log.debug(f"Finalized subtree rooted at {index.ids[split_root]}")
+                if hierarchy is not None:
+                    hierarchy.finalized(index.ids[split_root], max_chi)
+        accepted[new_split] = True
+        save_search_indexed(index, checkpoint, accepted, finalized, traversal, hierarchy)
+        if not end_iteration(metrics, progress, started, scored, len(new_split), int(accepted.sum()), int(finalized.sum()), budget):
+            return set(index.nodes[i] for i in np.flatnonzero(accepted))
+    return set(index.nodes[i] for i in np.flatnonzero(finalized))
+
+def find_splits_incremental(index, min_chi, min_mutations, weights=None, calculate_min_chi=False, tree_size=None, checkpoint=None, metrics=None, progress=logging.INFO, nthreads=1, bounded=False, hierarchy=None, budget=None):
+    #same search as find_splits_indexed, but subtree spectra and regions are built once and
+    #patched as splits are accepted, and only split roots whose region changed get rescored
+    accepted, finalized, traversal = start_search_indexed(index, checkpoint, hierarchy)
+    #a fresh unweighted search starts from the index's cached whole tree spectra
+    if weights is None and accepted.sum() == 1:
+        spectra = index.tree_spectra()
+    else:
+        spectra = index.subtree_spectra(index.branch_matrix(weights), accepted)
+    region = index.regions(accepted)
+    #split root -> (max_chi, max_chi_node), dropped when a split is accepted inside it. with bounded, a kept
+    #max_chi may be below its true value only when neither reaches min_chi, which never goes down between iterations
+    best = {}
+
+    while accepted.sum() > finalized.sum():
+        if calculate_min_chi:
+            min_chi = calculate_min_chi_value(tree_size, traversal)
+            traversal += 1
+            log.log(progress, f"Minimum chi for iteration {traversal - 1}: {min_chi}")
+        if hierarchy is not None:
+            hierarchy.start_iteration(min_chi)
+
+        log.debug(f"Starting iteration with {accepted.sum()-1} accepted splits and {finalized.sum()} finalized splits")
+        started = time.perf_counter()
+        scored = 0
+        new_split = []
+        split_roots = np.flatnonzero(accepted & ~finalized)
+        rescore = [split_root for split_root in split_roots if split_root not in best]
+        results = score_split_roots(lambda split_root: score_region(spectra, index.region_nodes(region, split_root), split_root, min_mutations, index, min_chi, bounded), rescore, nthreads)
+        for split_root, (max_chi, max_chi_node, ncandidates) in zip(rescore, results):
+            best[split_root] = (max_chi, max_chi_node)
+            scored += ncandidates
+        for split_root in split_roots:
+            max_chi, max_chi_node = best[split_root]
+            if max_chi > min_chi:
+                if max_chi_node is not None and not accepted[max_chi_node]:
+                    new_split.append((split_root, max_chi_node))
+                    log.debug(f"New split found at {index.ids[max_chi_node]} with x2 {max_chi}")
+                    #spectra in a region are only patched when a split is taken from it, below
+                    if hierarchy is not None:
+                        hierarchy.accepted(index.ids[split_root], index.ids[max_chi_node], max_chi, split_sides(spectra, split_root, max_chi_node))
+            else:
+                finalized[split_root] = True
+                log.debug(f"Finalized subtree rooted at {index.ids[split_root]}")
+                if hierarchy is not None:
+                    hierarchy.finalized(index.ids[split_root], max_chi)
+        #each new split sits in a different region, so the updates don't touch each other
+        for split_root, node in new_split:
+            index.cut_split(spectra, region, split_root, node)
+            accepted[node] = True
+            del best[split_root]
+        save_search_indexed(index, checkpoint, accepted, finalized, traversal, hierarchy)
+        if not end_iteration(metrics, progress, started, scored, len(new_split), int(accepted.sum()), int(finalized.sum()), budget):
+            return set(index.nodes[i] for i in np.flatnonzero(accepted))
+    return set(index.nodes[i] for i in np.flatnonzero(finalized))
+
+def get_spectra_indexed(index, finalized_splits, weights=None):
+    spectra = index.subtree_spectra(index.branch_matrix(weights), index.mask(finalized_splits))
+    return {split_root: spectrum_row_to_dict(spectra[index.index_of[split_root.id]]) for split_root in finalized_splits}
+
+### persistent worker pool for bootstraps. the tree (and index) reach each worker once, through fork,
+### when the pool starts, then replicates are handed out one at a time as workers free up
+_worker = {}
+
+def init_bootstrap_worker(target, tree, settings):
+    _worker["target"] = target
+    _worker["tree"] = tree
+    _worker["settings"] = settings
+
+def run_replicate_task(replicate):
+    #tsv replicates are written by the worker as soon as they're done, anything returned goes to the parent
+    #along with how long the replicate took in the worker
+    started = time.perf_counter()
+    result = _worker["target"](_worker["tree"], replicate, *_worker["settings"])
+    return replicate, result, time.perf_counter() - started
+
+def run_replicates(target, tree, settings, replicates, nthreads, on_done=None, metrics=None, kind=None):
+    #fork explicitly: MATree objects can't be pickled, workers have to inherit them
+    with get_context("fork").Pool(nthreads, initializer=init_bootstrap_worker, initargs=(target, tree, settings)) as pool:
+        for done, (replicate, result, seconds) in enumerate(pool.imap_unordered(run_replicate_task, replicates), 1):
+            if on_done is not None:
+                on_done(replicate, result)
+            if metrics is not None:
+                metrics.replicates_done(kind, {replicate: seconds})
+            log.info(f"Finished bootstrap no: {replicate} ({done}/{len(replicates)}) in {seconds:.2f}s")
+
+def replicate_filename(replicate, kind):
+    return f"bootstrap_{replicate}_{kind}_output.tsv"
+
+def spectra_records(spectra, tips_by_node=None, count_tips=True):
+    #one replicate as columns for the bootstrap store: node ids, type counts, totals and tip counts
+    nodes = sorted(spectra, key=lambda node: (node_depth(node), node.id))
+    tips = None
+    if count_tips:
+        tips = [len(tips_by_node[node]) if tips_by_node is not None else len(get_tips(spectra.keys(), node)) for node in nodes]
+    counts = [[spectra[node].get(mutation, 0) for mutation in MUTATION_TYPES] for node in nodes]
+    return [node.id for node in nodes], counts, [sum(spectra[node].values()) for node in nodes], tips
+
+def save_replicate(spectra, output_dir, replicate, kind, output, ntips=0, tips_by_node=None):
+    #tsv replicates are written where they're made, npz ones are handed back for the parent's store
+    if output == "npz":
+        return spectra_records(spectra, tips_by_node)
+    write_spectra_to_tsv(spectra, os.path.join(output_dir, replicate_filename(replicate, kind)), ntips, tips_by_node)
+    #still handed back (without tips) for the running split support tally
+    return spectra_records(spectra, count_tips=False)
+
+class ReplicateOutput:
+    '''
+    Where one kind of bootstrap replicate ("splits" or "spectra") goes: a TSV per replicate or one
+    columnar store (--bootstrap_output npz). With a checkpoint directory, replicates are written there,
+    finished ones are skipped on restart, and everything is linked into bootstrap_dir at the end.
+    '''
+    def __init__(self, kind, bootstrap_dir, checkpoint_dir=None, output="tsv"):
+        if bootstrap_dir != "." and not os.path.exists(bootstrap_dir):
+            os.makedirs(bootstrap_dir)
+        self.kind = kind
+        self.bootstrap_dir = bootstrap_dir
+        self.checkpoint_dir = checkpoint_dir
+        self.output = output
+        self.output_dir = checkpoint_dir if checkpoint_dir is not None else bootstrap_dir
+        self.store = None
+        if output == "npz":
+            store_path = os.path.join(self.output_dir, store_filename(kind))
+            #only a checkpointed run carries on with what is already in the store
+            if checkpoint_dir is None and os.path.exists(store_path):
+                os.remove(store_path)
+            self.store = BootstrapStore(store_path)
+
+    def todo(self, replicates):
+        if self.store is not None:
+            done = self.store.replicates()
+        elif self.checkpoint_dir is not None:
+            done = completed_replicates(self.checkpoint_dir, self.kind)
+        else:
+            done = set()
+        if done & set(replicates):
+            log.info(f"Skipping {len(done & set(replicates))} {self.kind} replicates already finished in {self.output_dir}")
+        return [replicate for replicate in replicates if replicate not in done]
+
+    def finished(self, replicate, records=None):
+        if self.store is not None:
+            self.store.add(replicate, records)
+        elif self.checkpoint_dir is not None:
+            record_replicate(self.checkpoint_dir, self.kind, replicate, replicate_filename(replicate, self.kind))
+
+    def close(self, replicates):
+        if self.store is not None:
+            self.store.close()
+        if self.checkpoint_dir is not None:
+            filenames = [store_filename(self.kind)] if self.store is not None else [replicate_filename(replicate, self.kind) for replicate in replicates]
+            link_replicates(self.checkpoint_dir, self.bootstrap_dir, filenames)
+
+def bootstrap_replicate ( tree, replicate, min_chi, min_mutations, ntips, max_branch_length, calculate_min_chi, bootstrap_dir=".", index=None, incremental=False, seed=None, output="tsv", bounded=False, tree_size=None ) :
+    #tree_size (for calculate_min_chi) defaults to the number of nodes searched, a collapsed tree passes its original size
+    log.debug(f"Begining bootstrap no: {replicate}")
+    rng = replicate_rng( seed, replicate )
+    if index is not None:
+        bootstrap_weights = draw_weights( len(index.positions), 1, rng )[:, 0]
+        search = find_splits_incremental if incremental else find_splits_indexed
+        finalized_splits_bootstrap = search(index, min_chi, min_mutations, bootstrap_weights, calculate_min_chi, tree_size=tree_size if tree_size is not None else index.size, progress=logging.DEBUG, bounded=bounded)
+        bootstrap_spectra = get_spectra_indexed(index, finalized_splits_bootstrap, bootstrap_weights)
+        return save_replicate(bootstrap_spectra, bootstrap_dir, replicate, "splits", output, ntips)
     positions = get_positions( tree.root )
-    bootstrap_weights = create_bootstrap( positions )
-    finalized_splits_bootstrap = find_splits(tree.root, min_chi, min_mutations, max_branch_length, bootstrap_weights, calculate_min_chi, tree_size=len( [n for n in tree.breadth_first_expansion()] ) )
+    bootstrap_weights = create_bootstrap( positions, rng=rng )
+    finalized_splits_bootstrap = find_splits(tree.root, min_chi, min_mutations, max_branch_length, bootstrap_weights, calculate_min_chi, tree_size=tree_size if tree_size is not None else len( [n for n in tree.breadth_first_expansion()] ), progress=logging.DEBUG, bounded=bounded )
     bootstrap_spectra = get_spectra(finalized_splits_bootstrap, max_branch_length, bootstrap_weights)
-    bootstrap_output_file = os.path.join(bootstrap_dir, f"bootstrap_{replicate}_splits_output.tsv")
-    write_spectra_to_tsv(bootstrap_spectra, bootstrap_output_file, ntips)
+    return save_replicate(bootstrap_spectra, bootstrap_dir, replicate, "splits", output, ntips)
 
 # Define the run_bootstrap function using explicit process creation
-def run_bootstrap(tree, nbootstraps, nthreads, min_chi, min_mutations, max_branch_length, calculate_min_chi, bootstrap_dir="."):
-    # Create bootstrap directory if it doesn't exist
-    if bootstrap_dir != "." and not os.path.exists(bootstrap_dir):
-        os.makedirs(bootstrap_dir)
-    
-    processes = []
-    # Create and start a process for each bootstrap replicate
-    for replicate in range(1, nbootstraps + 1):
-        p = Process(target=bootstrap_replicate, args=(tree, replicate, min_chi, min_mutations, 0, max_branch_length, calculate_min_chi, bootstrap_dir))
-        processes.append(p)
-        p.start()
-        # If we have reached the maximum number of threads, wait for them to finish
-        if len(processes) >= nthreads:
-            for p in processes:
-                p.join()
-            processes = []
-    # Wait for any remaining processes to finish
-    for p in processes:
-        p.join()
-
-    print(f"Bootstrap completed with {nbootstraps} replicates using {nthreads} threads.")
-
-def bootstrap_spectrum_replicate( tree, replicate, splits, max_branch_lengths, bootstrap_dir="."):
-    print(f"Begining bootstrap no: {replicate}", file=sys.stderr)
+def run_bootstrap(tree, nbootstraps, nthreads, min_chi, min_mutations, max_branch_length, calculate_min_chi, bootstrap_dir=".", index=None, incremental=False, checkpoint_dir=None, seed=None, replicates=None, output="tsv", support=None, metrics=None, bounded=False, tree_size=None):
+    replicates = range(1, nbootstraps + 1) if replicates is None else replicates
+    replicate_output = ReplicateOutput("splits", bootstrap_dir, checkpoint_dir, output)
+    settings = (min_chi, min_mutations, 0, max_branch_length, calculate_min_chi, replicate_output.output_dir, index, incremental, seed, output, bounded, tree_size)
+    def on_done(replicate, records):
+        #tallied before the replicate is marked finished, a replicate redone after a crash is only counted once
+        if support is not None:
+            support.add(replicate, records)
+        replicate_output.finished(replicate, records)
+    run_replicates(bootstrap_replicate, tree, settings, replicate_output.todo(replicates), nthreads, on_done, metrics, "splits")
+    replicate_output.close(replicates)
+    if support is not None:
+        support.close()
+    log.info(f"Bootstrap completed with {nbootstraps} replicates using {nthreads} threads.")
+
+def bootstrap_spectrum_replicate( tree, replicate, splits, max_branch_lengths, bootstrap_dir=".", seed=None, output="tsv"):
+    log.debug(f"Begining bootstrap no: {replicate}")
     positions = get_positions( tree.root )
-    bootstrap_weights = create_bootstrap( positions )
+    bootstrap_weights = create_bootstrap( positions, rng=replicate_rng( seed, replicate ) )
     bootstrap_spectra = get_spectra( splits, max_branch_lengths, bootstrap_weights)
-    bootstrap_output_file = os.path.join(bootstrap_dir, f"bootstrap_{replicate}_spectra_output.tsv")
-    write_spectra_to_tsv(bootstrap_spectra, bootstrap_output_file, 0)
+    return save_replicate(bootstrap_spectra, bootstrap_dir, replicate, "spectra", output)
 
 ### ok, botostrap by spectrum
-def run_bootstrap_spectra( tree, nbootstraps, nthreads, splits, max_branch_lengths, bootstrap_dir="." ) :
-    # Create bootstrap directory if it doesn't exist
-    if bootstrap_dir != "." and not os.path.exists(bootstrap_dir):
-        os.makedirs(bootstrap_dir)
-    
-    processes = []
-    # Create and start a process for each bootstrap replicate
-    for replicate in range(1, nbootstraps + 1):
-        p = Process(target=bootstrap_spectrum_replicate, args=(tree, replicate, splits, max_branch_lengths, bootstrap_dir))
-        processes.append(p)
-        p.start()
-        # If we have reached the maximum number of threads, wait for them to finish
-        if len(processes) >= nthreads:
-            for p in processes:
-                p.join()
-            processes = []
-    # Wait for any remaining processes to finish
-    for p in processes:
-        p.join()
-    print(f"Bootstrap spectrum completed with {nbootstraps} replicates using {nthreads} threads.")
+def run_bootstrap_spectra( tree, nbootstraps, nthreads, splits, max_branch_lengths, bootstrap_dir=".", checkpoint_dir=None, seed=None, replicates=None, output="tsv", metrics=None ) :
+    replicates = range(1, nbootstraps + 1) if replicates is None else replicates
+    replicate_output = ReplicateOutput("spectra", bootstrap_dir, checkpoint_dir, output)
+    settings = (splits, max_branch_lengths, replicate_output.output_dir, seed, output)
+    run_replicates(bootstrap_spectrum_replicate, tree, settings, replicate_output.todo(replicates), nthreads, replicate_output.finished, metrics, "spectra")
+    replicate_output.close(replicates)
+    log.info(f"Bootstrap spectrum completed with {nbootstraps} replicates using {nthreads} threads.")
+
+### bootstrap spectra on the index: the splits are fixed, so a whole batch of replicates is
+### one multinomial draw and one sparse product instead of a tree walk per replicate
+def run_bootstrap_spectra_batched( index, nbootstraps, splits, bootstrap_dir=".", batch_size=100, checkpoint_dir=None, seed=None, replicates=None, output="tsv", metrics=None ) :
+    replicates = range(1, nbootstraps + 1) if replicates is None else replicates
+    replicate_output = ReplicateOutput("spectra", bootstrap_dir, checkpoint_dir, output)
+    splits = list(splits)
+    #tips under each split are the same in every replicate
+    tips_by_node = {split: get_tips(splits, split) for split in splits}
+    for batch in replicate_batches(replicate_output.todo(replicates), batch_size):
+        log.debug(f"Begining bootstrap no: {batch[0]}-{batch[-1]}")
+        started = time.perf_counter()
+        #one column per replicate, each from that replicate's own stream
+        weights = np.column_stack([draw_weights(len(index.positions), 1, replicate_rng(seed, replicate))[:, 0] for replicate in batch])
+        spectra = split_spectra_matrix(index, splits, weights)
+        for column, replicate in enumerate(batch):
+            bootstrap_spectra = {split: spectrum_row_to_dict(spectra[i, :, column]) for i, split in enumerate(splits)}
+            records = save_replicate(bootstrap_spectra, replicate_output.output_dir, replicate, "spectra", output, 0, tips_by_node)
+            replicate_output.finished(replicate, records)
+        #replicates of a batch are computed together, each is given an equal share of the batch's time
+        seconds = (time.perf_counter() - started) / len(batch)
+        if metrics is not None:
+            metrics.replicates_done("spectra", {replicate: seconds for replicate in batch})
+        log.info(f"Finished bootstrap no: {batch[0]}-{batch[-1]} in {seconds * len(batch):.2f}s")
+    replicate_output.close(replicates)
+    log.info(f"Bootstrap spectrum completed with {len(replicates)} replicates in batches of {batch_size}.")
+
+### sweep: more split searches in the same process, one report per setting. all on one TreeIndex (a copy
+### per max_branch_length shares the topology and decoded mutations) and starting from its cached spectra
+SWEEP_KEYS = ["output", "min_chi", "min_mutations", "max_branch_length"]
+
+def parse_sweep(specs, args):
+    '''
+    --sweep settings ("output=PATH,min_chi=X,...") as dicts with output, min_chi, calculate_min_chi,
+    min_mutations and max_branch_length, defaults from the main run's arguments.
+    '''
+    settings = []
+    for spec in specs:
+        setting = {"output": None, "min_chi": args.min_chi, "calculate_min_chi": args.calculate_min_chi,
+                   "min_mutations": args.min_mutations, "max_branch_length": args.max_branch_length}
+        for item in spec.split(","):
+            key, _, value = item.partition("=")
+            if key not in SWEEP_KEYS or not value:
+                raise ValueError(f"Invalid --sweep setting {item} in {spec}, expected key=value with key one of {', '.join(SWEEP_KEYS)}")
+            if key == "min_chi":
+                setting["calculate_min_chi"] = value == "calculate"
+                setting["min_chi"] = args.min_chi if value == "calculate" else float(value)
+            elif key == "output":
+                setting["output"] = value
+            else:
+                setting[key] = int(value)
+        if setting["output"] is None:
+            raise ValueError(f"--sweep setting {spec} has no output")
+        settings.append(setting)
+    return settings
+
+def run_sweep(index, settings, tree_size, ntips, nthreads=1, bounded=False, metrics=None):
+    indexes = {index.max_branch_length: index}
+    for setting in settings:
+        with timed_stage(metrics, "sweep"):
+            max_branch_length = setting["max_branch_length"]
+            if max_branch_length not in indexes:
+                indexes[max_branch_length] = index.with_max_branch_length(max_branch_length)
+            sweep_index = indexes[max_branch_length]
+            finalized_splits = find_splits_incremental(sweep_index, setting["min_chi"], setting["min_mutations"], calculate_min_chi=setting["calculate_min_chi"], tree_size=tree_size, progress=logging.DEBUG, nthreads=nthreads, bounded=bounded)
+            write_spectra_to_tsv(get_spectra_indexed(sweep_index, finalized_splits), setting["output"], ntips)
+        log.info(f"Sweep with min_chi {'calculated' if setting['calculate_min_chi'] else setting['min_chi']}, min_mutations {setting['min_mutations']}, max_branch_length {max_branch_length}: {len(finalized_splits)} splits")
 
 def main():
 
     ### read args and tree
     args = parse_args()
-    tree = bte.MATree(args.input_tree)
-    nodes = [n for n in tree.breadth_first_expansion()]
+    #counted from here, loading the tree is part of the job's time
+    budget = TimeBudget(args.time_budget) if args.time_budget is not None else None
+    setup_logging(args.log_level)
+    sweep = parse_sweep(args.sweep, args)
+    metrics = RunMetrics(args.metrics_file, vars(args))
+    if args.seed is not None:
+        #exemplar tips in the report
+        random.seed(args.seed)
+    #from the tree cache (tree_cache.py) if there is one for this file
+    with timed_stage(metrics, "load_tree"):
+        tree = load_tree(args.input_tree)
+        nodes = [n for n in tree.breadth_first_expansion()]
+    #nodes stays the whole tree, its size is what calculate_min_chi corrects for
+    if args.collapse != "none":
+        with timed_stage(metrics, "collapse_tree"):
+            tree = CollapsedTree(tree, args.collapse)
+        log.info(tree.summary())
+
+    ### flatten the tree once if using the array engine, bootstrap workers inherit it
+    with timed_stage(metrics, "build_index"):
+        index = TreeIndex(tree.root, args.max_branch_length) if args.engine != "recursive" else None
+    incremental = args.engine == "incremental"
+
+    ### checkpoints are only reused by a run with the same tree and settings
+    checkpoint = None
+    if args.checkpoint_dir is not None or budget is not None:
+        tree_stat = os.stat(args.input_tree)
+        settings = {"input_tree": os.path.abspath(args.input_tree), "tree_size": tree_stat.st_size, "tree_mtime": tree_stat.st_mtime,
+                    "min_chi": args.min_chi, "min_mutations": args.min_mutations, "max_branch_length": args.max_branch_length,
+                    "calculate_min_chi": args.calculate_min_chi, "seed": args.seed}
+        #collapsing single child nodes changes nothing a checkpoint holds
+        if args.collapse == "zero":
+            settings["collapse"] = args.collapse
+        if args.checkpoint_dir is not None:
+            start_checkpoint_dir(args.checkpoint_dir, settings)
+            checkpoint = SearchCheckpoint(os.path.join(args.checkpoint_dir, "split_search.json"), settings)
+        else:
+            #a search stopped by --time_budget needs somewhere to leave its state
+            checkpoint = SearchCheckpoint(os.path.splitext(args.output_spectrum)[0] + ".search_state.json", settings)
 
     ### go through and do the real run without weighting mutations 
-    finalized_splits = find_splits(tree.root, args.min_chi, args.min_mutations, args.max_branch_length, calculate_min_chi=args.calculate_min_chi, tree_size=len(nodes) )
-    spectra = get_spectra(finalized_splits, args.max_branch_length )
-    write_spectra_to_tsv(spectra, args.output_spectrum, args.ntips)
+    hierarchy = SplitHierarchy() if args.split_hierarchy is not None else None
+    with timed_stage(metrics, "split_search"):
+        if index is not None:
+            search = find_splits_incremental if incremental else find_splits_indexed
+            finalized_splits = search(index, args.min_chi, args.min_mutations, calculate_min_chi=args.calculate_min_chi, tree_size=len(nodes), checkpoint=checkpoint, metrics=metrics, nthreads=args.nthreads, bounded=args.branch_and_bound, hierarchy=hierarchy, budget=budget )
+            spectra = get_spectra_indexed(index, finalized_splits )
+        else:
+            finalized_splits = find_splits(tree.root, args.min_chi, args.min_mutations, args.max_branch_length, calculate_min_chi=args.calculate_min_chi, tree_size=len(nodes), checkpoint=checkpoint, metrics=metrics, nthreads=args.nthreads, bounded=args.branch_and_bound, hierarchy=hierarchy, budget=budget )
+            spectra = get_spectra(finalized_splits, args.max_branch_length )
+    metrics.converged = budget is None or not budget.stopped
+    partial_spectrum = os.path.splitext(args.output_spectrum)[0] + ".not_converged.tsv"
+    if not metrics.converged:
+        #every split accepted so far, finalized or not, under a name that says so. no sweep or bootstraps
+        with timed_stage(metrics, "split_report"):
+            write_spectra_to_tsv(spectra, partial_spectrum, args.ntips)
+        log.warning(f"Split search did not converge within --time_budget, {len(finalized_splits)} splits accepted so far written to {partial_spectrum}. Run again with the same settings to carry on from {checkpoint.path}")
+        metrics.write()
+        sys.exit(3)
+    with timed_stage(metrics, "split_report"):
+        write_spectra_to_tsv(spectra, args.output_spectrum, args.ntips)
+    #left by an earlier run that ran out of time
+    if os.path.exists(partial_spectrum):
+        os.remove(partial_spectrum)
+    #the state kept next to the report only carries a search over --time_budget runs, once it has converged a
+    #later run (maybe with other settings) must start afresh rather than resume from or discard it
+    if args.checkpoint_dir is None and checkpoint is not None and os.path.exists(checkpoint.path):
+        os.remove(checkpoint.path)
+    if hierarchy is not None:
+        #subtree spectra of the splits come from an index, built here for the recursive engine
+        with timed_stage(metrics, "split_hierarchy"):
+            hierarchy_index = index if index is not None else TreeIndex(tree.root, args.max_branch_length)
+            hierarchy.write(args.split_hierarchy, hierarchy_index, {"input_tree": os.path.abspath(args.input_tree), "tree_size": len(nodes), "min_chi": args.min_chi,
+                            "calculate_min_chi": args.calculate_min_chi, "min_mutations": args.min_mutations, "max_branch_length": args.max_branch_length}, node_depth)
+
+    ### other settings on the same tree, before the bootstraps so their reports don't wait on them
+    if sweep:
+        if index is None:
+            with timed_stage(metrics, "build_index"):
+                index = TreeIndex(tree.root, args.max_branch_length)
+        run_sweep(index, sweep, len(nodes), args.ntips, args.nthreads, args.branch_and_bound, metrics)
+        #bootstraps stay on the engine asked for
+        if args.engine == "recursive":
+            index = None
 
     ### get bootstrap splits if requested
     if ( args.bootstrap_splits > 0 ) :
-        print(f"Bootstrapping splits with {args.bootstrap_splits} replicates using {args.nthreads} threads.", file=sys.stderr)
-        run_bootstrap( tree, args.bootstrap_splits, args.nthreads, args.min_chi, args.min_mutations, args.max_branch_length, args.calculate_min_chi, args.bootstrap_dir )
+        replicates = parse_replicate_range( args.replicate_range, args.bootstrap_splits )
+        log.info(f"Bootstrapping splits with {len(replicates)} replicates using {args.nthreads} threads.")
+        support = None
+        if args.bootstrap_report is not None:
+            state_path = os.path.join(args.checkpoint_dir, "split_support.json") if args.checkpoint_dir is not None else None
+            #main split fractions as in the report, node distances in the whole tree whether or not it was collapsed
+            main_splits = {split.id: [normalize_spectrum(spectra[split]).get(mutation_type, 0) for mutation_type in MUTATION_TYPES] for split in finalized_splits}
+            support = SplitSupport(main_splits, args.bootstrap_report, TreeOrder(nodes[0]), state_path)
+        with timed_stage(metrics, "bootstrap_splits"):
+            run_bootstrap( tree, args.bootstrap_splits, args.nthreads, args.min_chi, args.min_mutations, args.max_branch_length, args.calculate_min_chi, args.bootstrap_dir, index, incremental, args.checkpoint_dir, args.seed, replicates, args.bootstrap_output, support, metrics, args.branch_and_bound, len(nodes) )
 
     ###both of these dont need to exist maybe ill remove this 
     ### bootstrap spectrum requested:
     if ( args.bootstrap_spectra > 0 ) :
-        print(f"Bootstrapping spectra with {args.bootstrap_spectra} replicates using {args.nthreads} threads.", file=sys.stderr)
-        run_bootstrap_spectra( tree, args.bootstrap_spectra, args.nthreads, finalized_splits, args.max_branch_length, args.bootstrap_dir )
+        replicates = parse_replicate_range( args.replicate_range, args.bootstrap_spectra )
+        log.info(f"Bootstrapping spectra with {len(replicates)} replicates using {args.nthreads} threads.")
+        with timed_stage(metrics, "bootstrap_spectra"):
+            if index is not None:
+                run_bootstrap_spectra_batched( index, args.bootstrap_spectra, finalized_splits, args.bootstrap_dir, args.bootstrap_batch_size, args.checkpoint_dir, args.seed, replicates, args.bootstrap_output, metrics )
+            else:
+                run_bootstrap_spectra( tree, args.bootstrap_spectra, args.nthreads, finalized_splits, args.max_branch_length, args.bootstrap_dir, args.checkpoint_dir, args.seed, replicates, args.bootstrap_output, metrics )
+    metrics.write()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,204 @@
+import os
+import csv
+import json
+import logging
+import argparse
+import numpy as np
+from scipy.stats import chi2
+from mutation_table import MUTATION_TYPES, OTHER_COLUMN
+from checkpoint import atomic_write
+
+log = logging.getLogger(__name__)
+
+### record of a split search (which split root accepted which split, at which iteration, with what chi and
+### side totals) from which the splits and spectra of any stricter setting can be worked out without the tree.
+### each split root takes one new split per iteration from its own region, independently of the other split
+### roots, so with a higher min_chi every split root accepts the same splits in the same order, it just stops
+### at the first one whose chi no longer goes over the threshold. a higher min_mutations leaves the pick
+### unchanged as long as the recorded pick still has min_mutations on both sides. a split root's picks can
+### nest either way (a later pick may sit above an earlier one), so the spectra are split up by where each
+### kept split sits in the tree, not by which split root accepted it
+
+HIERARCHY_FORMAT = 2
+
+class SplitHierarchy:
+    '''
+    Collects the accepted splits of one search as it runs (find_splits and the index engines call
+    start_iteration, accepted and finalized), and writes them with every split's whole subtree spectrum.
+    The events go into the search checkpoint as well, so a resumed search still has all of them.
+    '''
+    def __init__(self):
+        self.iteration = 0
+        self.min_chi = None
+        self.events = []
+        #false when resumed from a checkpoint made without recording
+        self.complete = True
+
+    def start_iteration(self, min_chi):
+        self.iteration += 1
+        self.min_chi = float(min_chi)
+
+    def accepted(self, parent_id, split_id, chi, sides):
+        self.events.append({"iteration": self.iteration, "min_chi": self.min_chi, "parent": parent_id, "split": split_id,
+                            "chi": float(chi), "below": int(sides[0]), "above": int(sides[1])})
+
+    def finalized(self, split_id, chi):
+        self.events.append({"iteration": self.iteration, "min_chi": self.min_chi, "finalized": split_id, "chi": float(chi)})
+
+    def state(self):
+        return {"iteration": self.iteration, "events": self.events, "complete": self.complete}
+
+    def resume(self, state):
+        #state saved with the checkpoint, None if the checkpointed search wasn't recorded
+        if state is None:
+            log.warning("Resumed split search has no recorded hierarchy, the record will be incomplete")
+            self.complete = False
+            return
+        self.iteration = state["iteration"]
+        self.events = state["events"]
+        self.complete = state["complete"]
+
+    def write(self, path, index, settings, node_depth=None):
+        '''
+        Write the record with the whole subtree spectrum (13 columns), tip count, depth and postorder
+        range (first and last, the subtree of a split is every node numbered first..last) of the tree
+        root and every accepted split, from index (a TreeIndex of the tree searched, same max_branch_length).
+        node_depth(node) gives the depth the report sorts rows by, if not the depth in index.
+        '''
+        spectra = index.tree_spectra()
+        leaves = np.array([[node.is_leaf()] for node in index.nodes], dtype=np.int64)
+        tips = index.subtree_spectra(leaves)[:, 0]
+        root = index.ids[index.size - 1]
+        split_ids = [root] + [event["split"] for event in self.events if "split" in event]
+        splits = {}
+        for split_id in split_ids:
+            i = index.index_of[split_id]
+            depth = node_depth(index.nodes[i]) if node_depth is not None else index.depth[i]
+            splits[split_id] = {"spectrum": spectra[i].tolist(), "tips": int(tips[i]), "depth": int(depth),
+                                "first": int(index.first[i]), "last": int(i)}
+        record = {"format": HIERARCHY_FORMAT, "settings": settings, "root": root, "complete": self.complete,
+                  "iterations": self.iteration, "splits": splits, "events": self.events}
+        atomic_write(path, json.dumps(record))
+        log.info(f"Split hierarchy with {len(splits) - 1} accepted splits written to {path}")
+
+def load_hierarchy(path):
+    with open(path) as f:
+        record = json.load(f)
+    if record.get("format") != HIERARCHY_FORMAT:
+        raise ValueError(f"{path} is not a split hierarchy this version can read (format {record.get('format')}, not {HIERARCHY_FORMAT}), record it again with spectrumSplits.py --split_hierarchy")
+    if not record["complete"]:
+        raise ValueError(f"{path} was recorded from a resumed search that wasn't recorded before, it can't be replayed")
+    return record
+
+def replay_threshold(record, min_chi=None, calculate_min_chi=False):
+    #min_chi at a given iteration, calculated the way calculate_min_chi_value does it
+    tree_size = record["settings"]["tree_size"]
+    if calculate_min_chi:
+        return lambda iteration: chi2.ppf(1 - 0.05 / (tree_size * iteration), 11)
+    return lambda iteration: min_chi
+
+def replay_splits(record, min_chi=None, calculate_min_chi=False, min_mutations=None):
+    '''
+    Ids of the splits a search with these settings would finalize. Every threshold has to be at least the
+    recorded one wherever the replay needs it, otherwise ValueError: the recorded search stopped short
+    of what a looser search goes on to do, or a recorded pick lacks min_mutations and the stricter
+    search would have taken another node there.
+    '''
+    settings = record["settings"]
+    min_mutations = settings["min_mutations"] if min_mutations is None else min_mutations
+    if min_mutations < settings["min_mutations"]:
+        raise ValueError(f"min_mutations {min_mutations} is below the recorded {settings['min_mutations']}, rerun the search")
+    threshold = replay_threshold(record, min_chi, calculate_min_chi)
+    by_parent = {}
+    for event in record["events"]:
+        if "split" in event:
+            by_parent.setdefault(event["parent"], []).append(event)
+        else:
+            by_parent.setdefault(event["finalized"], []).append(event)
+
+    kept = [record["root"]]
+    stack = [record["root"]]
+    while stack:
+        split_root = stack.pop()
+        #a split root's events are one accepted split per iteration, ending with it being finalized
+        for event in sorted(by_parent.get(split_root, []), key=lambda event: event["iteration"]):
+            limit = threshold(event["iteration"])
+            if limit < event["min_chi"]:
+                raise ValueError(f"min_chi {limit} at iteration {event['iteration']} is below the recorded {event['min_chi']}, rerun the search")
+            if "finalized" in event or event["chi"] <= limit:
+                break
+            if event["below"] < min_mutations or event["above"] < min_mutations:
+                raise ValueError(f"Recorded split {event['split']} has fewer than {min_mutations} mutations on one side, the search would pick another node there, rerun it")
+            kept.append(event["split"])
+            stack.append(event["split"])
+    return kept
+
+def kept_ancestors(record, kept):
+    '''
+    Kept split -> the nearest kept split above it in the tree (the root has none). Subtree ranges
+    nest, so walking them by first node (the enclosing range before the ones inside it) with a stack
+    of the ranges still open leaves each split's nearest kept ancestor on top of the stack.
+    '''
+    ranges = sorted(kept, key=lambda split_id: (record["splits"][split_id]["first"], -record["splits"][split_id]["last"]))
+    ancestors = {}
+    open_ranges = []
+    for split_id in ranges:
+        last = record["splits"][split_id]["last"]
+        while open_ranges and record["splits"][open_ranges[-1]]["last"] < last:
+            open_ranges.pop()
+        if open_ranges:
+            ancestors[split_id] = open_ranges[-1]
+        open_ranges.append(split_id)
+    return ancestors
+
+def replay_spectra(record, kept):
+    #spectrum (13 columns) and tip count of each kept split, less the kept splits directly below it in the tree
+    spectra = {split_id: np.array(record["splits"][split_id]["spectrum"], dtype=np.int64) for split_id in kept}
+    tips = {split_id: record["splits"][split_id]["tips"] for split_id in kept}
+    for split_id, ancestor in kept_ancestors(record, kept).items():
+        spectra[ancestor] -= np.array(record["splits"][split_id]["spectrum"], dtype=np.int64)
+        tips[ancestor] -= record["splits"][split_id]["tips"]
+    return spectra, tips
+
+def write_replay_report(record, kept, filename):
+    '''
+    Split report in the layout of write_spectra_to_tsv without exemplar tips (--ntips 0), rows in
+    the same order.
+    '''
+    spectra, tips = replay_spectra(record, kept)
+    sorted_keys = sorted(MUTATION_TYPES)
+    tmp_filename = filename + ".part"
+    with open(tmp_filename, "w", newline="") as file:
+        writer = csv.writer(file, delimiter='\t')
+        writer.writerow(["Node_ID", "Total_Mutations", "Number_Tips", "Mutations:Tips"] + sorted_keys + ["Exemplar tips"])
+        for split_id in sorted(kept, key=lambda split_id: (record["splits"][split_id]["depth"], split_id)):
+            counts = {mutation_type: int(spectra[split_id][i]) for i, mutation_type in enumerate(MUTATION_TYPES) if spectra[split_id][i]}
+            if spectra[split_id][OTHER_COLUMN]:
+                counts["other"] = int(spectra[split_id][OTHER_COLUMN])
+            total = sum(counts.values())
+            if total == 0:
+                raise ValueError("Cannot normalize because the total sum of values is 0.")
+            ntips = tips[split_id]
+            writer.writerow([split_id, total, ntips, float(total) / float(ntips) if ntips > 0 else "NA"] + [counts[key] / total if key in counts else 0 for key in sorted_keys])
+    os.replace(tmp_filename, filename)
+    log.info(f"Spectra written to {filename}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Splits and spectra for a stricter min_chi/min_mutations, replayed from a split hierarchy recorded with spectrumSplits.py --split_hierarchy, without the tree.")
+    parser.add_argument("--hierarchy", type=str, required=True, help="Split hierarchy JSON written by spectrumSplits.py --split_hierarchy")
+    parser.add_argument("--output_spectrum", type=str, required=True, help="Output TSV file for spectra")
+    parser.add_argument("--min_chi", type=float, default=None, help="Minimum Chi-square value to accept a split (default: as recorded)")
+    parser.add_argument("--calculate_min_chi", action="store_true", help="Calculate the minimum chi-square value from the tree size, as spectrumSplits.py does")
+    parser.add_argument("--min_mutations", type=int, default=None, help="Minimum number of mutations required for a split (default: as recorded)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    record = load_hierarchy(args.hierarchy)
+    settings = record["settings"]
+    if args.min_chi is None and not args.calculate_min_chi:
+        args.min_chi, args.calculate_min_chi = settings["min_chi"], settings["calculate_min_chi"]
+    kept = replay_splits(record, args.min_chi, args.calculate_min_chi, args.min_mutations)
+    log.info(f"{len(kept)} splits at min_chi {'calculated' if args.calculate_min_chi else args.min_chi}, min_mutations {args.min_mutations or settings['min_mutations']}")
+    write_replay_report(record, kept, args.output_spectrum)
+
+if __name__ == "__main__":
+    main()
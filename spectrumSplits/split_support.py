@@ -0,0 +1,232 @@
+import os
+import re
+import math
+import logging
+import csv
+import json
+import argparse
+import numpy as np
+from tree_index import MUTATION_TYPES
+from traversal import TreeOrder
+from checkpoint import atomic_write
+from bootstrap_store import store_filename, load_bootstrap_store
+from tree_cache import load_tree
+
+log = logging.getLogger(__name__)
+
+### running bootstrap support for splits, tallied in the parent as each replicate finishes so the
+### report can be watched while the bootstraps run instead of re-reading every replicate afterwards.
+### the bootstraps resample positions on a fixed tree, so a split node coming back is its clade coming back.
+### a main split that doesn't come back exactly is compared with the nearest split of the replicate: how many
+### branches away it is (node distance) and how alike their spectra are (weighted jaccard similarity of the
+### 12-type fractions), the two measures the README uses to judge splits that shift between replicates.
+### sums are kept exactly, so the report doesn't depend on the order replicates finish in.
+### run as a script it tallies the replicates already stored in a bootstrap directory, so the report can
+### be made again without rerunning the search and its bootstraps
+
+SPLITS_FILE = re.compile(r"^bootstrap_(\d+)_splits_output\.tsv$")
+SUPPORT_FORMAT = 2
+
+def add_exact(partials, x):
+    #shewchuk's running sum (the recipe behind math.fsum): the partials add up to the sum exactly, so
+    #math.fsum(partials) comes out the same whatever order the values were added in
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        high = x + y
+        low = y - (high - x)
+        if low:
+            partials[i] = low
+            i += 1
+        x = high
+    partials[i:] = [x]
+
+def weighted_jaccard(a, b):
+    #similarity of two spectra (fractions): 1 when identical, 0 when they share no mutation type
+    return float(np.minimum(a, b).sum() / np.maximum(a, b).sum())
+
+class SplitDistance:
+    '''
+    Branches from each main split to the nearest of a set of nodes, from a TreeOrder of the whole tree.
+    Going up from a main split preorder numbers fall and subtree ends rise, so the lowest common ancestor
+    with any node is found by two binary searches along the main split's ancestors.
+    '''
+    def __init__(self, order, main_split_ids):
+        self.order = order
+        parent = order.parent.tolist()
+        depth = [0] * len(parent)
+        for i in range(1, len(parent)):
+            depth[i] = depth[parent[i]] + 1
+        self.depth = np.array(depth, dtype=np.int64)
+        #main split id -> preorder indices of the split and each of its ancestors up to the root
+        self.ancestors = {}
+        for split_id in main_split_ids:
+            chain = [order.index_of[split_id]]
+            while parent[chain[-1]] >= 0:
+                chain.append(parent[chain[-1]])
+            self.ancestors[split_id] = np.array(chain, dtype=np.int64)
+
+    def positions(self, node_ids):
+        return np.array([self.order.index_of[node_id] for node_id in node_ids], dtype=np.int64)
+
+    def nearest(self, split_id, positions):
+        #(distance, which of positions) of the node nearest the main split, the first of positions on a tie
+        chain = self.ancestors[split_id]
+        #first ancestor numbered at or before the node, and first whose subtree ends after it
+        lowest = np.maximum(np.searchsorted(-chain, -positions), np.searchsorted(self.order.end[chain], positions, side="right"))
+        distance = self.depth[chain[0]] + self.depth[positions] - 2 * self.depth[chain[lowest]]
+        nearest = int(np.argmin(distance))
+        return int(distance[nearest]), nearest
+
+class SplitSupport:
+    '''
+    How often every split node reappears across bootstrap replicates, with the mean and SD of its
+    total and normalized 12-type spectrum over the replicates it appears in. Nodes that only show up
+    in replicates are tallied too, so alternative splits are visible in the report.
+    main_splits (main split id -> its 12-type fractions) are also compared with the nearest split of
+    every replicate: mean node distance, mean jaccard similarity of the spectra, and near support
+    (a split on the main split or one branch away, since resampling often shifts a split by a branch).
+    order is a TreeOrder of the whole tree, whether or not the search ran on a collapsed copy.
+    With a state_path the tally is saved after every replicate and picked up again on restart.
+    '''
+    def __init__(self, main_splits, report_path, order, state_path=None, report_every=10):
+        self.main_splits = {split_id: np.asarray(fractions, dtype=np.float64) for split_id, fractions in main_splits.items()}
+        self.main_split_ids = set(self.main_splits)
+        self.distance = SplitDistance(order, self.main_splits)
+        self.report_path = report_path
+        self.state_path = state_path
+        self.report_every = report_every
+        self.replicates = set()
+        #node id -> [count, sums, sums of squares], exact partial sums of each of (total, 12 fractions)
+        self.tally = {}
+        #main split id -> replicates with a split on it or one branch away, summed node distance and
+        #partial sums of jaccard similarity to the nearest split
+        self.near = {split_id: 0 for split_id in self.main_split_ids}
+        self.node_distance = {split_id: 0 for split_id in self.main_split_ids}
+        self.jaccard = {split_id: [] for split_id in self.main_split_ids}
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            if state.get("format") != SUPPORT_FORMAT:
+                raise ValueError(f"{state_path} is split support saved by an older version, remove it (the report is redone from the stored replicates by split_support.py)")
+            self.replicates = set(state["replicates"])
+            self.tally = state["tally"]
+            self.near.update(state["near"])
+            self.node_distance.update(state["node_distance"])
+            self.jaccard.update(state["jaccard"])
+            log.info(f"Resuming split support from {state_path}: {len(self.replicates)} replicates tallied")
+
+    def add(self, replicate, records):
+        #records as made by spectra_records: node ids, 12-type counts and totals of one replicate's splits
+        if replicate in self.replicates:
+            return
+        node_ids, counts, totals = records[:3]
+        counts = np.asarray(counts, dtype=np.float64).reshape(-1, len(MUTATION_TYPES))
+        totals = np.asarray(totals, dtype=np.float64)
+        #normalized by the total including any non-standard types, as in the reports
+        values = np.column_stack([totals, counts / np.where(totals > 0, totals, 1)[:, None]])
+        for node_id, value in zip(node_ids, values.tolist()):
+            count, sums, squares = self.tally.get(node_id, [0, [[] for _ in value], [[] for _ in value]])
+            for x, partials, square_partials in zip(value, sums, squares):
+                add_exact(partials, x)
+                add_exact(square_partials, x * x)
+            self.tally[node_id] = [count + 1, sums, squares]
+        positions = self.distance.positions(node_ids)
+        for split_id in self.main_split_ids:
+            distance, nearest = self.distance.nearest(split_id, positions)
+            if distance <= 1:
+                self.near[split_id] += 1
+            self.node_distance[split_id] += distance
+            add_exact(self.jaccard[split_id], weighted_jaccard(self.main_splits[split_id], values[nearest, 1:]))
+        self.replicates.add(replicate)
+        if self.state_path is not None:
+            self.save()
+        if len(self.replicates) % self.report_every == 0:
+            self.write_report()
+
+    def save(self):
+        state = {"format": SUPPORT_FORMAT, "replicates": sorted(self.replicates), "tally": self.tally,
+                 "near": self.near, "node_distance": self.node_distance, "jaccard": self.jaccard}
+        atomic_write(self.state_path, json.dumps(state))
+
+    def summary(self, node_id):
+        #count, means and SDs of (total, 12 fractions) of a node over the replicates it's in
+        count, sums, squares = self.tally.get(node_id, [0, [[]] * (len(MUTATION_TYPES) + 1), [[]] * (len(MUTATION_TYPES) + 1)])
+        means, sds = [], []
+        for partials, square_partials in zip(sums, squares):
+            total = math.fsum(partials)
+            means.append(total / count if count > 0 else math.nan)
+            sds.append(math.sqrt(max(0.0, (math.fsum(square_partials) - total * total / count) / (count - 1))) if count > 1 else math.nan)
+        return count, means, sds
+
+    def write_report(self):
+        sorted_keys = sorted(MUTATION_TYPES)
+        columns = [1 + MUTATION_TYPES.index(key) for key in sorted_keys]
+        nreplicates = len(self.replicates)
+        #main splits first, then by support
+        node_ids = sorted(set(self.tally) | self.main_split_ids, key=lambda node_id: (node_id not in self.main_split_ids, -self.tally.get(node_id, [0])[0], node_id))
+        tmp_path = self.report_path + ".part"
+        with open(tmp_path, "w", newline="") as file:
+            writer = csv.writer(file, delimiter='\t')
+            writer.writerow(["Node_ID", "Main_Split", "Replicates", "Support_Count", "Support", "Near_Support_Count", "Mean_Node_Distance", "Mean_Jaccard",
+                             "Mean_Total_Mutations", "SD_Total_Mutations"] + [f"Mean_{key}" for key in sorted_keys] + [f"SD_{key}" for key in sorted_keys])
+            for node_id in node_ids:
+                count, means, sds = self.summary(node_id)
+                main = node_id in self.main_split_ids and nreplicates > 0
+                row = [node_id, node_id in self.main_split_ids, nreplicates, count, count / nreplicates if nreplicates > 0 else "NA",
+                       self.near[node_id] if main else "NA", self.node_distance[node_id] / nreplicates if main else "NA",
+                       math.fsum(self.jaccard[node_id]) / nreplicates if main else "NA", means[0], sds[0]]
+                writer.writerow(row + [means[i] for i in columns] + [sds[i] for i in columns])
+        os.replace(tmp_path, self.report_path)
+
+    def close(self):
+        self.write_report()
+        log.info(f"Split support over {len(self.replicates)} replicates written to {self.report_path}")
+
+def main_split_fractions(spectrum_file):
+    #main split id -> 12-type fractions, from a split report
+    with open(spectrum_file, newline="") as file:
+        return {row["Node_ID"]: [float(row[mutation_type]) for mutation_type in MUTATION_TYPES] for row in csv.DictReader(file, delimiter='\t')}
+
+def stored_replicates(bootstrap_dir):
+    '''
+    (replicate, records) of every split replicate in bootstrap_dir, by replicate number: from its
+    bootstrap_splits.npz if there is one, from the bootstrap_{i}_splits_output.tsv files otherwise.
+    '''
+    store_path = os.path.join(bootstrap_dir, store_filename("splits"))
+    if os.path.exists(store_path):
+        columns = load_bootstrap_store(store_path)
+        for replicate in np.unique(columns["replicate"]).tolist():
+            rows = np.flatnonzero(columns["replicate"] == replicate)
+            yield replicate, (columns["node_id"][rows].tolist(), columns["counts"][rows], columns["total"][rows])
+        return
+    replicates = sorted((int(match.group(1)), filename) for filename in os.listdir(bootstrap_dir) for match in [SPLITS_FILE.match(filename)] if match)
+    for replicate, filename in replicates:
+        with open(os.path.join(bootstrap_dir, filename), newline="") as file:
+            rows = list(csv.DictReader(file, delimiter='\t'))
+        totals = np.array([int(row["Total_Mutations"]) for row in rows], dtype=np.int64)
+        #the TSVs hold fractions of the total, the counts behind them are whole numbers (weights are multinomial draws)
+        fractions = np.array([[float(row[mutation_type]) for mutation_type in MUTATION_TYPES] for row in rows]).reshape(-1, len(MUTATION_TYPES))
+        yield replicate, ([row["Node_ID"] for row in rows], np.rint(fractions * totals[:, None]).astype(np.int64), totals)
+
+def main():
+    parser = argparse.ArgumentParser(description="Split support report from the bootstrap replicates stored in a directory, the report spectrumSplits.py --bootstrap_report tallies while they run.")
+    parser.add_argument("--bootstrap_dir", type=str, required=True, help="Directory with bootstrap_{i}_splits_output.tsv files or bootstrap_splits.npz")
+    parser.add_argument("--spectrum_file", type=str, required=True, help="Split report of the run the replicates bootstrap, its splits are the main splits")
+    parser.add_argument("--output_file", type=str, required=True, help="Output TSV of split support")
+    parser.add_argument("--input_tree", type=str, required=True, help="Tree (or its cache) the splits are on, for the node distance from each main split to the nearest replicate split")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    main_splits = main_split_fractions(args.spectrum_file)
+    replicates = list(stored_replicates(args.bootstrap_dir))
+    if not replicates:
+        raise ValueError(f"No split replicates in {args.bootstrap_dir}")
+    #written once at the end rather than every few replicates
+    support = SplitSupport(main_splits, args.output_file, TreeOrder(load_tree(args.input_tree).root), report_every=len(replicates) + 1)
+    for replicate, records in replicates:
+        support.add(replicate, records)
+    support.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import numpy as np
+
+### explicit stack tree walks, so ladder-like trees thousands of levels deep don't hit python's
+### recursion limit. both visit children in their own order, the same order a recursive walk does,
+### so anything that depends on visiting order (tie breaking, tip lists) comes out the same
+
+def preorder(root, skip=None):
+    '''
+    Nodes of root's subtree, each before its children. Children for which skip(child) is true are
+    left out together with their subtrees (root itself is always visited).
+    '''
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        for child in reversed(node.children):
+            if skip is None or not skip(child):
+                stack.append(child)
+
+def postorder(root, skip=None):
+    '''
+    Nodes of root's subtree, each after all of its children, the order a recursive walk finishes them.
+    skip works as in preorder.
+    '''
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            yield node
+            continue
+        stack.append((node, True))
+        for child in reversed(node.children):
+            if skip is None or not skip(child):
+                stack.append((child, False))
+
+class TreeOrder:
+    '''
+    Preorder and postorder of a whole tree worked out once, for code that walks the same tree many
+    times. Nodes are numbered in preorder: nodes[i]'s subtree is nodes[i:end[i]], parent[i] is the
+    index of its parent (-1 for the root), and post lists the indices in postorder.
+    '''
+    def __init__(self, root):
+        self.nodes = list(preorder(root))
+        self.index_of = {node.id: i for i, node in enumerate(self.nodes)}
+        self.parent = np.array([self.index_of[node.parent.id] if i > 0 else -1 for i, node in enumerate(self.nodes)], dtype=np.int64)
+        self.post = np.array([self.index_of[node.id] for node in postorder(root)], dtype=np.int64)
+        #children come after their parent in preorder, so one backwards pass adds up subtree sizes
+        parent = self.parent.tolist()
+        size = [1] * len(self.nodes)
+        for i in range(len(self.nodes) - 1, 0, -1):
+            size[parent[i]] += size[i]
+        self.end = np.arange(len(self.nodes)) + np.array(size, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def subtree(self, node):
+        i = self.index_of[node.id]
+        return self.nodes[i:self.end[i]]
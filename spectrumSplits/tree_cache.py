@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+import bte
+from mutation_table import decode_mutations
+
+### preprocessed copy of a MAT, written once per tree so later stages don't each decompress and parse
+### the protobuf again. a directory of plain .npy arrays next to the tree ({tree}.cache), so they can be
+### memory mapped, plus meta.json holding the sha256 of the source it was made from
+
+CACHE_FORMAT = 1
+ARRAYS = ["parent", "ids", "leaf", "mut_offsets", "mut_pos", "mut_ref", "mut_alt"]
+
+def cache_dir_for(tree_path):
+    return tree_path + ".cache"
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def tree_arrays(tree):
+    '''
+    Topology and mutations of a MATree as arrays, nodes in preorder (children in their original order):
+    parent index (-1 for the root), node ids, leaf flags, and the mutations of node i in
+    mut_offsets[i]:mut_offsets[i+1] as position and ASCII ref/alt base codes.
+    '''
+    nodes = []
+    parents = []
+    stack = [(tree.root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(nodes)
+        nodes.append(node)
+        parents.append(parent)
+        for child in reversed(node.children):
+            stack.append((child, index))
+    table = decode_mutations(nodes)
+    return {"parent": np.array(parents, dtype=np.int64),
+            "ids": np.array([node.id for node in nodes], dtype=str),
+            "leaf": np.array([not node.children for node in nodes], dtype=bool),
+            "mut_offsets": table.offsets, "mut_pos": table.pos, "mut_ref": table.ref, "mut_alt": table.alt}
+
+def write_tree_cache(tree_path, cache_dir=None):
+    cache_dir = cache_dir_for(tree_path) if cache_dir is None else cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    sha256 = file_sha256(tree_path)
+    arrays = tree_arrays(bte.MATree(tree_path))
+    #meta.json goes last, a cache without it (or with another hash) is never used
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for name in ARRAYS:
+        np.save(os.path.join(cache_dir, name + ".npy"), arrays[name])
+    meta = {"format": CACHE_FORMAT, "source": os.path.abspath(tree_path), "sha256": sha256,
+            "nodes": len(arrays["parent"]), "mutations": len(arrays["mut_pos"])}
+    with open(meta_path + ".part", "w") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + ".part", meta_path)
+    print(f"Cached {meta['nodes']} nodes and {meta['mutations']} mutations of {tree_path} in {cache_dir}", file=sys.stderr)
+
+def read_tree_cache(tree_path, cache_dir=None):
+    #the cached arrays (memory mapped) if there is a cache made from this exact file, otherwise None
+    cache_dir = cache_dir_for(tree_path) if cache_dir is None else cache_dir
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("format") != CACHE_FORMAT or meta.get("sha256") != file_sha256(tree_path):
+        print(f"Ignoring stale tree cache {cache_dir}", file=sys.stderr)
+        return None
+    return {name: np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r") for name in ARRAYS}
+
+class CachedNode:
+    '''
+    Read-only stand-in for a bte node: id, parent, children, mutations, is_leaf().
+    Mutation strings are only built when a node's mutations are first asked for.
+    '''
+    __slots__ = ("id", "parent", "children", "index", "tree", "_mutations")
+
+    def __init__(self, tree, index, node_id, parent):
+        self.tree = tree
+        self.index = index
+        self.id = node_id
+        self.parent = parent
+        self.children = []
+        self._mutations = None
+
+    @property
+    def mutations(self):
+        if self._mutations is None:
+            arrays = self.tree.arrays
+            lo, hi = arrays["mut_offsets"][self.index], arrays["mut_offsets"][self.index + 1]
+            self._mutations = [f"{chr(ref)}{pos}{chr(alt)}" for ref, pos, alt in zip(arrays["mut_ref"][lo:hi].tolist(), arrays["mut_pos"][lo:hi].tolist(), arrays["mut_alt"][lo:hi].tolist())]
+        return self._mutations
+
+    @property
+    def branch_length(self):
+        return len(self.mutations)
+
+    def is_leaf(self):
+        return not self.children
+
+class CachedTree:
+    '''
+    The parts of the bte.MATree interface the read-only scripts use (root, breadth_first_expansion,
+    depth_first_expansion, get_node, get_leaves), built from a tree cache. The arrays themselves are
+    kept in .arrays for code that can work on them directly.
+    '''
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.nodes = []
+        parents = arrays["parent"].tolist()
+        for index, node_id in enumerate(arrays["ids"].tolist()):
+            parent = self.nodes[parents[index]] if parents[index] >= 0 else None
+            node = CachedNode(self, index, node_id, parent)
+            if parent is not None:
+                parent.children.append(node)
+            self.nodes.append(node)
+        self.root = self.nodes[0]
+        self.by_id = None
+
+    def depth_first_expansion(self):
+        #nodes are stored in preorder
+        return list(self.nodes)
+
+    def breadth_first_expansion(self):
+        expansion = [self.root]
+        i = 0
+        while i < len(expansion):
+            expansion.extend(expansion[i].children)
+            i += 1
+        return expansion
+
+    def get_node(self, node_id):
+        if self.by_id is None:
+            self.by_id = {node.id: node for node in self.nodes}
+        return self.by_id[node_id]
+
+    def get_leaves(self):
+        return [node for node in self.nodes if node.is_leaf()]
+
+    def get_leaves_ids(self):
+        return [node.id for node in self.get_leaves()]
+
+def load_tree(tree_path):
+    '''
+    Tree from its cache when there is an up to date one, parsed with bte otherwise. Only for scripts
+    that read the tree; anything that edits and saves it needs the real bte.MATree.
+    '''
+    arrays = read_tree_cache(tree_path)
+    if arrays is None:
+        return bte.MATree(tree_path)
+    print(f"Loading {tree_path} from its tree cache", file=sys.stderr)
+    return CachedTree(arrays)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the preprocessed cache of a tree, read by the other scripts in place of the protobuf.")
+    parser.add_argument("--input_tree", type=str, required=True, help="Input tree file (protobuf format)")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Cache directory (default: input tree path + .cache, where the other scripts look for it)")
+    args = parser.parse_args()
+    write_tree_cache(args.input_tree, args.cache_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import copy
+import numpy as np
+from scipy.sparse import csr_matrix
+from mutation_table import MUTATION_TYPES, OTHER_COLUMN, NCOLUMNS, decode_mutations
+
+class TreeIndex:
+    '''
+    Flattened copy of a MATree for the array based split search.
+    Nodes are numbered in the same postorder compute_mutation_spectrum fills spectrum_dict,
+    so node i always comes after all of its descendants and ties resolve the same way.
+    '''
+    def __init__(self, root, max_branch_length=100000):
+        self.nodes = []
+        parents = []
+        depths = []
+        #explicit stack, (node, parent index, depth, children done)
+        stack = [(root, -1, 0, False)]
+        pending_parent = {}
+        while stack:
+            node, parent, depth, expanded = stack.pop()
+            if not expanded:
+                stack.append((node, parent, depth, True))
+                for child in reversed(node.children):
+                    stack.append((child, None, depth + 1, False))
+                continue
+            index = len(self.nodes)
+            self.nodes.append(node)
+            parents.append(-1)
+            depths.append(depth)
+            for child in node.children:
+                parents[pending_parent.pop(child.id)] = index
+            pending_parent[node.id] = index
+        self.size = len(self.nodes)
+        self.parent = np.array(parents, dtype=np.int64)
+        self.depth = np.array(depths, dtype=np.int64)
+        self.ids = [node.id for node in self.nodes]
+        self.index_of = {node_id: i for i, node_id in enumerate(self.ids)}
+
+        #group nodes by depth so the cumulative pass can handle one level at a time
+        order = np.argsort(self.depth, kind="stable")
+        boundaries = np.flatnonzero(np.diff(self.depth[order])) + 1
+        self.levels = np.split(order, boundaries)
+        #in postorder every subtree is the contiguous block first[i] .. i
+        subtree_size = self.subtree_spectra(np.ones((self.size, 1), dtype=np.int64))[:, 0]
+        self.first = np.arange(self.size) - subtree_size + 1
+
+        #every mutation decoded once (mutation_table.py): owning node, position and type column
+        self.mutations = decode_mutations(self.nodes)
+        self.mut_node = self.mutations.node
+        self.mut_pos = self.mutations.pos
+        self.mut_type = self.mutations.types()
+        #bootstrap weights are drawn over every position seen in the tree
+        self.positions, self.mut_pos_index = np.unique(self.mut_pos, return_inverse=True)
+        self.keep_branches(max_branch_length)
+
+    def keep_branches(self, max_branch_length):
+        #branches longer than max_branch_length are left out of every spectrum
+        self.max_branch_length = max_branch_length
+        branch_lengths = np.bincount(self.mut_node, minlength=self.size)
+        self.mut_kept = branch_lengths[self.mut_node] <= max_branch_length
+        #(node, type) x position counts, so weighted branch counts are one sparse product
+        self.incidence = self.position_incidence(np.arange(self.size))
+        self.branch_counts = self.branch_matrix()
+        self.whole_tree_spectra = None
+
+    def with_max_branch_length(self, max_branch_length):
+        #copy sharing the topology and decoded mutations, with another max_branch_length
+        index = copy.copy(self)
+        index.keep_branches(max_branch_length)
+        return index
+
+    def tree_spectra(self):
+        '''
+        Unweighted spectrum of every subtree with nothing cut off (what every search starts from),
+        worked out once. Callers that change it get a copy.
+        '''
+        if self.whole_tree_spectra is None:
+            self.whole_tree_spectra = self.subtree_spectra(self.branch_counts)
+        return self.whole_tree_spectra.copy()
+
+    def position_incidence(self, row_of_node, nrows=None):
+        '''
+        Sparse (row * 13 + type) x position matrix of kept mutation counts, where row_of_node maps
+        every node to the row it is summed into (itself, or e.g. its split root).
+        '''
+        nrows = self.size if nrows is None else nrows
+        cells = row_of_node[self.mut_node[self.mut_kept]] * NCOLUMNS + self.mut_type[self.mut_kept]
+        counts = np.ones(len(cells), dtype=np.int64)
+        return csr_matrix((counts, (cells, self.mut_pos_index[self.mut_kept])), shape=(nrows * NCOLUMNS, len(self.positions)))
+
+    def position_weights(self, weights):
+        #position -> count dict (as made by create_bootstrap) to a vector over self.positions
+        return np.array([weights.get(int(p), 0) for p in self.positions], dtype=np.int64)
+
+    def branch_matrix(self, weights=None):
+        '''
+        Per-branch mutation type counts, N x 13. With weights (position -> count dict as made by
+        create_bootstrap, or a vector over self.positions) each mutation counts as many times
+        as its position was drawn.
+        '''
+        if weights is None or (isinstance(weights, dict) and not weights):
+            cells = self.mut_node[self.mut_kept] * NCOLUMNS + self.mut_type[self.mut_kept]
+            return np.bincount(cells, minlength=self.size * NCOLUMNS).astype(np.int64).reshape(self.size, NCOLUMNS)
+        if isinstance(weights, dict):
+            weights = self.position_weights(weights)
+        return (self.incidence @ weights).astype(np.int64).reshape(self.size, NCOLUMNS)
+
+    def subtree_spectra(self, branch, stop_mask=None):
+        '''
+        Spectrum of every subtree in one cumulative pass from the deepest level up.
+        Nodes flagged in stop_mask keep their own subtree but are not added to their parent,
+        the same as passing them as stop_nodes to compute_mutation_spectrum.
+        '''
+        spectra = branch.copy()
+        for level in reversed(self.levels[1:]):
+            if stop_mask is not None:
+                level = level[~stop_mask[level]]
+            np.add.at(spectra, self.parent[level], spectra[level])
+        return spectra
+
+    def regions(self, split_mask):
+        '''
+        For every node, the index of the closest split root at or above it (root must be a split).
+        '''
+        region = np.where(split_mask, np.arange(self.size), -1)
+        for level in self.levels[1:]:
+            level = level[~split_mask[level]]
+            region[level] = region[self.parent[level]]
+        return region
+
+    def region_nodes(self, region, split_root):
+        #nodes belonging to split_root, in postorder, only looking inside its own subtree
+        lo = self.first[split_root]
+        return lo + np.flatnonzero(region[lo:split_root + 1] == split_root)
+
+    def cut_split(self, spectra, region, split_root, node):
+        '''
+        Accept node as a new split inside split_root's region, updating spectra and region in place.
+        Only the ancestors of node up to split_root lose its subtree spectrum, and only the part of
+        node's subtree that belonged to split_root moves over to node.
+        '''
+        lo = self.first[split_root]
+        block = np.arange(lo, split_root + 1)
+        path = block[(self.first[lo:split_root + 1] <= node) & (block > node) & (region[lo:split_root + 1] == split_root)]
+        spectra[path] -= spectra[node]
+        below = region[self.first[node]:node + 1]
+        below[below == split_root] = node
+
+    def mask(self, nodes):
+        mask = np.zeros(self.size, dtype=bool)
+        mask[[self.index_of[node.id] for node in nodes]] = True
+        return mask
+
+def spectrum_row_to_dict(row):
+    #back to the dict layout get_spectra returns so write_spectra_to_tsv can stay as is
+    spectrum = {mutation_type: int(row[i]) for i, mutation_type in enumerate(MUTATION_TYPES) if row[i]}
+    if row[OTHER_COLUMN]:
+        spectrum["other"] = int(row[OTHER_COLUMN])
+    return spectrum